@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+
+# Import the Twee backups of many Trakt accounts at once, without any user input. Each
+# account is imported in a worker process of its own, inside its own state directory, so it
+# has its own config.json, pytrakt.json and local database - and its own rate limit, since
+# Trakt's limits apply to each user. Resolved shows are shared between the accounts through
+# an SQLite database, so a show only needs to be searched for once across all of them.
+#
+# The accounts are listed in a JSON manifest. Relative paths are relative to the manifest.
+#
+#   {
+#       "shared_show_cache": "showCache.db",
+#       "accounts": [
+#           {
+#               "name": "alice",
+#               "backup": "backups/alice.json",
+#               "state_dir": "state/alice",
+#               "config": {
+#                   "CLIENT_ID": "...",
+#                   "CLIENT_SECRET": "...",
+#                   "TRAKT_USERNAME": "alice"
+#               },
+#               "pytrakt": "credentials/alice.json"
+#           }
+#       ]
+#   }
+#
+# The 'config' values are written to the config.json of the state directory, and the
+# 'pytrakt' file (created by authenticating with twee_to_trakt.py) is copied into it. Both
+# can be left out when the state directory already has them.
+
+LOG_FORMAT = "%(asctime)s [%(levelname)7s] :: %(message)s"
+
+
+class BatchImportError(Exception):
+    pass
+
+
+def loadManifest(manifestPath):
+    with open(manifestPath) as f:
+        manifest = json.load(f)
+
+    baseDirectory = os.path.dirname(os.path.abspath(manifestPath))
+
+    def resolvePath(path):
+        return None if path is None else os.path.join(baseDirectory, path)
+
+    accounts = []
+    for index, account in enumerate(manifest["accounts"]):
+        for key in ("backup", "state_dir"):
+            if key not in account:
+                raise BatchImportError(
+                    f"Account {index + 1} in '{manifestPath}' is missing '{key}'."
+                )
+        accounts.append(
+            {
+                "name": account.get("name", f"account-{index + 1}"),
+                "backup": resolvePath(account["backup"]),
+                "state_dir": resolvePath(account["state_dir"]),
+                "config": account.get("config", {}),
+                "pytrakt": resolvePath(account.get("pytrakt")),
+            }
+        )
+
+    return accounts, resolvePath(manifest.get("shared_show_cache"))
+
+
+# Write the config.json and pytrakt.json of an account into its state directory
+
+
+def prepareStateDirectory(account, sharedShowCachePath):
+    stateDirectory = account["state_dir"]
+    os.makedirs(stateDirectory, exist_ok=True)
+
+    configPath = os.path.join(stateDirectory, "config.json")
+    config = {}
+    if os.path.exists(configPath):
+        with open(configPath) as f:
+            config = json.load(f)
+    config.update(account["config"])
+    if sharedShowCachePath is not None:
+        config["SHARED_SHOW_CACHE_PATH"] = sharedShowCachePath
+    with open(configPath, "w") as f:
+        json.dump(config, f, indent=4)
+
+    if account["pytrakt"] is not None:
+        shutil.copyfile(
+            account["pytrakt"], os.path.join(stateDirectory, "pytrakt.json")
+        )
+
+
+# Import a single account. This runs in a new worker process, since the import keeps its
+# state (the config, the local database and the rate limiter) in module level variables
+# which are set up when twee_to_trakt is imported, from the current directory.
+
+
+def importAccount(account, sharedShowCachePath, importOptions):
+    startTime = time.time()
+    result = {"name": account["name"], "status": "failed"}
+    try:
+        prepareStateDirectory(account, sharedShowCachePath)
+        os.chdir(account["state_dir"])
+        # Each account logs to a file in its own state directory
+        logging.basicConfig(
+            filename="import.log",
+            format=LOG_FORMAT,
+            level=logging.INFO,
+            datefmt="%Y-%m-%d %H:%M:%S",
+        )
+
+        import twee_to_trakt
+
+        # There's nobody to authenticate with Trakt, so the account must be authenticated already
+        if not twee_to_trakt.isAuthenticated():
+            raise BatchImportError(
+                "Not authenticated with Trakt - run twee_to_trakt.py once in the state directory, "
+                + "or add a 'pytrakt' file to the manifest."
+            )
+        twee_to_trakt.useTraktAuth()
+
+        # Shows which need a manual selection are skipped, so the import never waits for input
+        twee_to_trakt.processWatchedShows(
+            account["backup"],
+            resolve_first=True,
+            defer_prompts=True,
+            metrics_file="metrics.json",
+            **importOptions,
+        )
+
+        result.update(
+            {
+                "status": "completed",
+                "syncedEpisodes": len(twee_to_trakt.syncedEpisodeIds),
+                "deferredShows": len(twee_to_trakt.deferredSelections),
+                "exhaustedEpisodes": len(twee_to_trakt.retryQueue.exhausted),
+            }
+        )
+        twee_to_trakt.storage.close()
+    except (Exception, SystemExit) as e:
+        logging.exception(f"The import of '{account['name']}' failed.")
+        result["error"] = str(e) or type(e).__name__
+
+    result["elapsedSeconds"] = time.time() - startTime
+    return result
+
+
+def runImportTask(task):
+    return importAccount(*task)
+
+
+# Import every account, with up to the given number of accounts at a time. Returns the
+# result of each account, in the order they finished.
+
+
+def runBatch(accounts, processes=4, sharedShowCachePath=None, **importOptions):
+    tasks = [(account, sharedShowCachePath, importOptions) for account in accounts]
+    results = []
+    # Every account gets a fresh process, so that no state is carried over between them
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(processes, maxtasksperchild=1) as pool:
+        for result in pool.imap_unordered(runImportTask, tasks):
+            if result["status"] == "completed":
+                logging.info(
+                    f"Imported '{result['name']}' in {result['elapsedSeconds']:.0f} seconds: "
+                    + f"{result['syncedEpisodes']} episodes imported, {result['deferredShows']} shows "
+                    + f"waiting for a manual selection, {result['exhaustedEpisodes']} episodes which failed."
+                )
+            else:
+                logging.error(
+                    f"The import of '{result['name']}' failed: {result['error']}"
+                )
+            results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format=LOG_FORMAT,
+        level=logging.INFO,
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+
+    parser = argparse.ArgumentParser(
+        description="Import the Twee backups of many Trakt accounts, without any user input."
+    )
+    parser.add_argument("manifest", help="the JSON manifest listing the accounts")
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=4,
+        help="how many accounts to import at the same time (default: 4)",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="match the shows and episodes, without adding anything to Trakt",
+    )
+    parser.add_argument(
+        "--skip-watched",
+        action="store_true",
+        help="download each account's Trakt watch history first, and skip episodes which are already watched",
+    )
+    parser.add_argument("--json", metavar="PATH", help="also write the results here")
+    args = parser.parse_args()
+
+    try:
+        accounts, sharedShowCachePath = loadManifest(args.manifest)
+    except (OSError, ValueError, KeyError, BatchImportError) as e:
+        logging.error(f"The manifest '{args.manifest}' could not be read: {e}")
+        sys.exit(1)
+
+    results = runBatch(
+        accounts,
+        processes=args.processes,
+        sharedShowCachePath=sharedShowCachePath,
+        dry_run=args.dry_run,
+        skip_watched=args.skip_watched,
+    )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    failedCount = sum(1 for result in results if result["status"] != "completed")
+    if failedCount:
+        logging.error(f"{failedCount} of {len(results)} accounts failed to import.")
+        sys.exit(1)
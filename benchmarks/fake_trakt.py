@@ -0,0 +1,375 @@
+import gzip
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# A local stand-in for the parts of the Trakt API which the import uses, so the import can be
+# measured without touching the live API. The catalog of shows is built from a Twee backup,
+# so every show in the backup can be found, along with its seasons and episodes.
+#
+# The server can add latency to every response, enforce its own rate limits (responding with
+# 429, 'Retry-After' and 'X-Ratelimit' like Trakt does), respond with an HTML page instead
+# of JSON (like Trakt does when it's down) or with a 503, and make shows ambiguous by adding
+# a second show with the same title for every Twee show which doesn't have a year. Responses
+# are compressed when the client accepts gzip, and the connections which the client opened
+# are counted, so keep-alive can be checked.
+
+
+def slugify(text):
+    return re.sub(r"[^a-z0-9]+", "-", text.lower()).strip("-")
+
+
+class RateLimit(object):
+    def __init__(self, name, limit, periodSeconds):
+        self.lock = threading.Lock()
+        self.name = name
+        self.limit = limit
+        self.periodSeconds = periodSeconds
+        self.tokens = limit
+        self.updatedAt = time.monotonic()
+
+    # Take a token for a request, returning how long to wait when there are none left
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.limit,
+                self.tokens + (now - self.updatedAt) * self.limit / self.periodSeconds,
+            )
+            self.updatedAt = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) * self.periodSeconds / self.limit
+
+    def header(self):
+        return json.dumps(
+            {
+                "name": self.name,
+                "period": self.periodSeconds,
+                "limit": self.limit,
+                "remaining": int(self.tokens),
+                "until": time.strftime(
+                    "%Y-%m-%dT%H:%M:%SZ",
+                    time.gmtime(time.time() + self.periodSeconds),
+                ),
+            }
+        )
+
+
+class FakeTraktServer(object):
+    def __init__(
+        self,
+        backup,
+        latencySeconds=0.0,
+        getLimit=(100000, 1),
+        postLimit=(100000, 1),
+        rateLimitEvery=0,
+        invalidEvery=0,
+        unavailableEvery=0,
+        missing=0.0,
+        seed=0,
+        port=0,
+    ):
+        self.latencySeconds = latencySeconds
+        self.rateLimits = {
+            "GET": RateLimit("AUTHED_API_GET_LIMIT", *getLimit),
+            "POST": RateLimit("AUTHED_API_POST_LIMIT", *postLimit),
+        }
+        self.rateLimitEvery = rateLimitEvery
+        self.invalidEvery = invalidEvery
+        self.unavailableEvery = unavailableEvery
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.requestsCount = 0
+        self.connectionsCount = 0
+        # Trakt episode IDs of the episodes which were added to the history
+        self.watchedEpisodeIds = set()
+        self.buildCatalog(backup, missing, random.Random(seed))
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                with server.lock:
+                    server.connectionsCount += 1
+
+            def do_GET(self):
+                server.handle(self, "GET")
+
+            def do_POST(self):
+                server.handle(self, "POST")
+
+        self.httpServer = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.httpServer.daemon_threads = True
+        self.baseUrl = f"http://127.0.0.1:{self.httpServer.server_address[1]}/"
+
+    def buildCatalog(self, backup, missing, rng):
+        self.shows = {}
+        self.episodes = {}
+        traktId = 0
+        for profile in backup:
+            for tweeShow in profile["Shows"]:
+                seasons = {}
+                for episode in tweeShow["Episodes"]:
+                    seasonNo = int(episode["Season"])
+                    seasons[seasonNo] = max(
+                        seasons.get(seasonNo, 0), int(episode["Episode"])
+                    )
+
+                year = (
+                    int(tweeShow["FirstAired"].split("-")[0])
+                    if tweeShow["FirstAired"]
+                    else None
+                )
+                # Shows without a year get a second show with the same title
+                years = [year] if year else [2000, 2010]
+                for index, showYear in enumerate(years):
+                    traktId += 1
+                    slug = slugify(tweeShow["Name"])
+                    if index > 0:
+                        slug += f"-{showYear}"
+                    # Leave out the last episode of some seasons, as if Trakt was missing it
+                    showSeasons = {
+                        seasonNo: episodesCount - (1 if rng.random() < missing else 0)
+                        for seasonNo, episodesCount in seasons.items()
+                    }
+                    self.shows[slug] = {
+                        "title": tweeShow["Name"],
+                        "year": showYear,
+                        "ids": {
+                            "trakt": traktId,
+                            "slug": slug,
+                            "tvdb": traktId,
+                            "imdb": f"tt{traktId:07d}",
+                            "tmdb": traktId,
+                        },
+                        "seasons": showSeasons,
+                    }
+                    for seasonNo, episodesCount in showSeasons.items():
+                        for episodeNo in range(1, episodesCount + 1):
+                            episodeTraktId = self.getEpisodeTraktId(
+                                traktId, seasonNo, episodeNo
+                            )
+                            self.episodes[episodeTraktId] = (slug, seasonNo, episodeNo)
+
+        self.showsByTitle = {}
+        for show in self.shows.values():
+            self.showsByTitle.setdefault(show["title"].lower(), []).append(show)
+
+    @staticmethod
+    def getEpisodeTraktId(showTraktId, seasonNo, episodeNo):
+        return showTraktId * 100000 + seasonNo * 1000 + episodeNo
+
+    def start(self):
+        threading.Thread(target=self.httpServer.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpServer.shutdown()
+        self.httpServer.server_close()
+
+    def handle(self, request, method):
+        url = urlparse(request.path)
+        path = url.path.strip("/")
+        query = parse_qs(url.query)
+        body = None
+        if method == "POST":
+            length = int(request.headers.get("Content-Length") or 0)
+            body = json.loads(request.rfile.read(length) or b"null")
+
+        with self.lock:
+            self.requestsCount += 1
+            forceRateLimit = (
+                self.rateLimitEvery and self.requestsCount % self.rateLimitEvery == 0
+            )
+            isInvalid = (
+                self.invalidEvery and self.requestsCount % self.invalidEvery == 0
+            )
+            isUnavailable = (
+                self.unavailableEvery
+                and self.requestsCount % self.unavailableEvery == 0
+            )
+
+        if self.latencySeconds:
+            time.sleep(self.latencySeconds)
+
+        rateLimit = self.rateLimits[method]
+        retryAfter = rateLimit.take()
+        if forceRateLimit and not retryAfter:
+            retryAfter = 1
+        if retryAfter:
+            self.record(method, "rate-limited")
+            return self.respond(
+                request, 429, None, rateLimit, {"Retry-After": str(int(retryAfter) + 1)}
+            )
+
+        if isInvalid:
+            self.record(method, "invalid")
+            return self.respondHtml(request)
+        if isUnavailable:
+            self.record(method, "unavailable")
+            return self.respond(request, 503, None, rateLimit)
+
+        endpoint, status, data = self.route(method, path, query, body)
+        self.record(method, endpoint)
+        self.respond(request, status, data, rateLimit)
+
+    def record(self, method, endpoint):
+        with self.lock:
+            self.calls[f"{method} {endpoint}"] += 1
+
+    def respond(self, request, status, data, rateLimit, headers=None):
+        content = json.dumps(data).encode() if data is not None else b""
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        if content and "gzip" in request.headers.get("Accept-Encoding", ""):
+            content = gzip.compress(content)
+            request.send_header("Content-Encoding", "gzip")
+        request.send_header("Content-Length", str(len(content)))
+        request.send_header("X-Ratelimit", rateLimit.header())
+        for name, value in (headers or {}).items():
+            request.send_header(name, value)
+        request.end_headers()
+        request.wfile.write(content)
+
+    def respondHtml(self, request):
+        content = b"<html><body>Service Unavailable</body></html>"
+        request.send_response(200)
+        request.send_header("Content-Type", "text/html")
+        request.send_header("Content-Length", str(len(content)))
+        request.end_headers()
+        request.wfile.write(content)
+
+    def route(self, method, path, query, body):
+        if method == "GET" and path == "search/show":
+            results = self.showsByTitle.get(query.get("query", [""])[0].lower(), [])
+            return (
+                "search/show",
+                200,
+                [
+                    {"type": "show", "score": 1000, "show": self.showSummary(show)}
+                    for show in results
+                ],
+            )
+
+        match = re.fullmatch(r"shows/([^/]+)/seasons", path)
+        if method == "GET" and match:
+            show = self.shows.get(match.group(1))
+            if show is None:
+                return "shows/:id/seasons", 404, None
+            withEpisodes = "episodes" in query.get("extended", [""])[0]
+            return (
+                "shows/:id/seasons",
+                200,
+                [
+                    self.seasonSummary(show, seasonNo, withEpisodes)
+                    for seasonNo in sorted(show["seasons"])
+                ],
+            )
+
+        match = re.fullmatch(r"shows/([^/]+)/seasons/(\d+)/episodes/(\d+)", path)
+        if method == "GET" and match:
+            show = self.shows.get(match.group(1))
+            seasonNo, episodeNo = int(match.group(2)), int(match.group(3))
+            if show is None or episodeNo > show["seasons"].get(seasonNo, 0):
+                return "shows/:id/seasons/:season/episodes/:episode", 404, None
+            return (
+                "shows/:id/seasons/:season/episodes/:episode",
+                200,
+                self.episodeSummary(show, seasonNo, episodeNo),
+            )
+
+        if method == "POST" and path == "sync/history":
+            added = 0
+            notFound = []
+            for episode in (body or {}).get("episodes", []):
+                if episode["ids"].get("trakt") in self.episodes:
+                    with self.lock:
+                        self.watchedEpisodeIds.add(episode["ids"]["trakt"])
+                    added += 1
+                else:
+                    notFound.append(episode)
+            return (
+                "sync/history",
+                201,
+                {
+                    "added": {"movies": 0, "episodes": added},
+                    "not_found": {
+                        "movies": [],
+                        "shows": [],
+                        "seasons": [],
+                        "episodes": notFound,
+                    },
+                },
+            )
+
+        if method == "GET" and path == "sync/watched/shows":
+            return "sync/watched/shows", 200, self.watchedShows()
+
+        return path, 404, None
+
+    def showSummary(self, show):
+        return {"title": show["title"], "year": show["year"], "ids": dict(show["ids"])}
+
+    def seasonSummary(self, show, seasonNo, withEpisodes):
+        season = {
+            "number": seasonNo,
+            "ids": {"trakt": show["ids"]["trakt"] * 100 + seasonNo},
+            "episode_count": show["seasons"][seasonNo],
+        }
+        if withEpisodes:
+            season["episodes"] = [
+                self.episodeSummary(show, seasonNo, episodeNo)
+                for episodeNo in range(1, show["seasons"][seasonNo] + 1)
+            ]
+        return season
+
+    def episodeSummary(self, show, seasonNo, episodeNo):
+        return {
+            "season": seasonNo,
+            "number": episodeNo,
+            "title": f"Episode {episodeNo}",
+            "ids": {
+                "trakt": self.getEpisodeTraktId(
+                    show["ids"]["trakt"], seasonNo, episodeNo
+                )
+            },
+        }
+
+    def watchedShows(self):
+        watched = {}
+        with self.lock:
+            watchedEpisodeIds = list(self.watchedEpisodeIds)
+        for episodeTraktId in watchedEpisodeIds:
+            slug, seasonNo, episodeNo = self.episodes[episodeTraktId]
+            seasons = watched.setdefault(slug, {})
+            seasons.setdefault(seasonNo, []).append(episodeNo)
+        return [
+            {
+                "plays": sum(len(episodes) for episodes in seasons.values()),
+                "show": self.showSummary(self.shows[slug]),
+                "seasons": [
+                    {
+                        "number": seasonNo,
+                        "episodes": [
+                            {"number": episodeNo, "plays": 1}
+                            for episodeNo in sorted(episodes)
+                        ],
+                    }
+                    for seasonNo, episodes in sorted(seasons.items())
+                ],
+            }
+            for slug, seasons in watched.items()
+        ]
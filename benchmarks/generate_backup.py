@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import random
+
+# Generate a synthetic Twee backup, in the same format as the backups which the Twee app
+# creates (and which load_rows reads), with roughly the requested number of watched episodes.
+# The shows are spread over a few profiles, and some episodes are left unwatched.
+#
+# A fraction of the shows can be made ambiguous: they're stored without the year that they
+# first aired, so the fake Trakt server returns more than one show with the same title.
+
+
+def generateBackup(episodes, profiles=2, ambiguity=0.0, seed=0):
+    rng = random.Random(seed)
+    backup = [{"Shows": []} for _ in range(profiles)]
+    watchedTotal = 0
+    seriesId = 0
+    episodeId = 0
+
+    while watchedTotal < episodes:
+        seriesId += 1
+        seasonsCount = rng.randint(1, 8)
+        episodesPerSeason = rng.randint(6, 24)
+        firstAired = rng.randint(1960, 2022)
+
+        show = {
+            "Name": f"Synthetic Show {seriesId:05d}",
+            "SeriesId": str(seriesId),
+            "FirstAired": ""
+            if rng.random() < ambiguity
+            else f"{firstAired}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            "Episodes": [],
+        }
+
+        for seasonNo in range(1, seasonsCount + 1):
+            for episodeNo in range(1, episodesPerSeason + 1):
+                episodeId += 1
+                # Most episodes are watched, and stop once the requested number is reached
+                watched = watchedTotal < episodes and rng.random() < 0.9
+                show["Episodes"].append(
+                    {
+                        "Season": str(seasonNo),
+                        "Episode": str(episodeNo),
+                        "EpisodeId": str(episodeId),
+                        "Watched": "1" if watched else "0",
+                        "Aired": f"{firstAired + seasonNo - 1}-{rng.randint(1, 12):02d}-"
+                        + f"{rng.randint(1, 28):02d}T20:00:00",
+                    }
+                )
+                if watched:
+                    watchedTotal += 1
+
+        backup[seriesId % profiles]["Shows"].append(show)
+
+    return backup
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic Twee backup.")
+    parser.add_argument(
+        "--episodes", type=int, default=1000, help="number of watched episodes"
+    )
+    parser.add_argument("--profiles", type=int, default=2, help="number of profiles")
+    parser.add_argument(
+        "--ambiguity",
+        type=float,
+        default=0.0,
+        help="fraction of shows which need a manual selection",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument(
+        "-o", "--output", default="twee.json", help="the backup file to write"
+    )
+    args = parser.parse_args()
+
+    with open(args.output, "w") as f:
+        json.dump(
+            generateBackup(args.episodes, args.profiles, args.ambiguity, args.seed), f
+        )
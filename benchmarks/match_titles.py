@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+# Measure how well the search results are matched to Twee titles, with a corpus of labeled
+# cases: a Twee title (with its year and the number of seasons watched), the results which
+# Trakt returns when it's searched for, and which of the results is the right show (or null
+# when none of them are). Each case is matched by the title matcher of the import, and by the
+# word by word check which older versions of the script used, and the outcomes are counted:
+#
+#   correct   the right show was picked automatically
+#   wrong     a show was picked automatically, but it isn't the right one
+#   prompt    the user would be asked to pick from more than one show
+#   missed    no shows were left, although one of the results is the right show
+#   rejected  no shows were left, and none of the results are the right show
+#
+#   python benchmarks/match_titles.py
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CORPUS_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "title_corpus.json"
+)
+
+
+def scoredMatch(twee_to_trakt, case, shows, seasons):
+    matcher = twee_to_trakt.titleMatcher
+    ranked = matcher.rank(
+        case["name"],
+        case["year"],
+        shows,
+        case["seasons"],
+        getSeasonsCount=lambda show: seasons[id(show)],
+    )
+    if matcher.isConfident(ranked):
+        return [ranked[0][1]]
+    return [show for _, show in ranked]
+
+
+def getOutcome(case, shows, matched):
+    expected = case["expected"]
+    if len(matched) == 1:
+        if expected is not None and matched[0] is shows[expected]:
+            return "correct"
+        return "wrong"
+    if matched:
+        return "prompt"
+    return "rejected" if expected is None else "missed"
+
+
+def evaluate(twee_to_trakt, corpus, matchers, repeat):
+    results = {}
+    for matcherName, match in matchers.items():
+        outcomes = {
+            outcome: 0
+            for outcome in ("correct", "wrong", "prompt", "missed", "rejected")
+        }
+        failures = []
+        elapsedSeconds = 0
+        for case in corpus:
+            shows = [
+                twee_to_trakt.buildShow(
+                    result["title"],
+                    result["year"],
+                    {
+                        "slug": f"show-{index}",
+                        "trakt": index,
+                        "imdb": None,
+                        "tmdb": None,
+                        "tvdb": None,
+                    },
+                )
+                for index, result in enumerate(case["results"])
+            ]
+            seasons = {
+                id(show): result["seasons"]
+                for show, result in zip(shows, case["results"])
+            }
+
+            startTime = time.perf_counter()
+            for _ in range(repeat):
+                matched = match(case, shows, seasons)
+            elapsedSeconds += time.perf_counter() - startTime
+
+            outcome = getOutcome(case, shows, matched)
+            outcomes[outcome] += 1
+            if outcome in ("wrong", "missed"):
+                failures.append(f"{case['name']} ({case['year']}): {outcome}")
+
+        results[matcherName] = {
+            "outcomes": outcomes,
+            "failures": failures,
+            "microsecondsPerMatch": elapsedSeconds / (len(corpus) * repeat) * 1e6,
+        }
+    return results
+
+
+def printReport(corpus, results):
+    print(f"{len(corpus)} labeled cases")
+    print(
+        f"{'matcher':<10}{'correct':>9}{'wrong':>7}{'prompt':>8}{'missed':>8}"
+        + f"{'rejected':>10}{'us/match':>10}"
+    )
+    for matcherName, result in results.items():
+        outcomes = result["outcomes"]
+        print(
+            f"{matcherName:<10}{outcomes['correct']:>9}{outcomes['wrong']:>7}"
+            + f"{outcomes['prompt']:>8}{outcomes['missed']:>8}{outcomes['rejected']:>10}"
+            + f"{result['microsecondsPerMatch']:>10.1f}"
+        )
+    for matcherName, result in results.items():
+        for failure in result["failures"]:
+            print(f"  {matcherName}: {failure}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure how well Trakt search results are matched to Twee titles."
+    )
+    parser.add_argument(
+        "--corpus", default=CORPUS_PATH, help="the labeled cases (JSON)"
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1000,
+        help="how many times each case is matched, for the timings",
+    )
+    parser.add_argument("--json", metavar="PATH", help="also write the results here")
+    args = parser.parse_args()
+
+    with open(args.corpus) as f:
+        corpus = json.load(f)
+
+    # The importer reads its config.json, and opens its local database, from the current
+    # directory when it's imported
+    with tempfile.TemporaryDirectory() as stateDirectory:
+        with open(os.path.join(stateDirectory, "config.json"), "w") as f:
+            json.dump(
+                {
+                    "TRAKT_USERNAME": "benchmark",
+                    "CLIENT_ID": "id",
+                    "CLIENT_SECRET": "secret",
+                },
+                f,
+            )
+        os.chdir(stateDirectory)
+        sys.path.insert(0, REPOSITORY_PATH)
+        import twee_to_trakt
+
+        results = evaluate(
+            twee_to_trakt,
+            corpus,
+            {
+                # The filtering of older versions of the script, which the importer still
+                # uses to read the selections which they stored
+                "legacy": lambda case, shows, seasons: (
+                    twee_to_trakt.filterLegacySearchResults(
+                        case["name"], case["year"], shows
+                    )
+                ),
+                "scored": lambda case, shows, seasons: scoredMatch(
+                    twee_to_trakt, case, shows, seasons
+                ),
+            },
+            args.repeat,
+        )
+        twee_to_trakt.storage.close()
+        os.chdir(REPOSITORY_PATH)
+
+    printReport(corpus, results)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
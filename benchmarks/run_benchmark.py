@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_trakt import FakeTraktServer
+from generate_backup import generateBackup
+
+# Measure the import against a local fake Trakt server, with synthetic Twee backups of
+# different sizes. For each size, the import is run twice in a fresh state directory: once
+# to import every episode, and once more to measure how long resuming a finished import
+# takes. Each run happens in a process of its own, since the importer keeps its state in
+# module level variables, and so that its peak memory can be measured.
+#
+#   python benchmarks/run_benchmark.py --sizes 1000 10000 100000 --latency-ms 20
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Run a single import, inside the child process
+
+
+def runImport(stateDirectory, backupFilename, stream):
+    os.chdir(stateDirectory)
+    sys.path.insert(0, REPOSITORY_PATH)
+
+    # Point PyTrakt at the fake credentials. The import is pointed at the fake server by the
+    # TRAKT_BASE_URL in its config.json.
+    import trakt.core
+
+    trakt.core.CONFIG_PATH = os.path.join(stateDirectory, "pytrakt.json")
+
+    import twee_to_trakt
+
+    startTime = time.perf_counter()
+    # Shows which need a manual selection are deferred, so the import never waits for input
+    twee_to_trakt.processWatchedShows(
+        backupFilename,
+        dry_run=False,
+        stream=stream,
+        resolve_first=not stream,
+        defer_prompts=True,
+    )
+    elapsedSeconds = time.perf_counter() - startTime
+
+    print(
+        json.dumps(
+            {
+                "elapsedSeconds": elapsedSeconds,
+                # ru_maxrss is reported in kilobytes on Linux
+                "peakMemoryMegabytes": resource.getrusage(
+                    resource.RUSAGE_SELF
+                ).ru_maxrss
+                / 1024,
+                "syncedEpisodes": len(twee_to_trakt.syncedEpisodeIds),
+            }
+        )
+    )
+
+
+def runChild(stateDirectory, backupFilename, stream, verbose):
+    command = [
+        sys.executable,
+        os.path.abspath(__file__),
+        "--child",
+        stateDirectory,
+        backupFilename,
+    ]
+    if stream:
+        command.append("--stream")
+    result = subprocess.run(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=None if verbose else subprocess.DEVNULL,
+        check=True,
+        text=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def prepareStateDirectory(stateDirectory, backup, baseUrl, configOverrides):
+    with open(os.path.join(stateDirectory, "twee.json"), "w") as f:
+        json.dump(backup, f)
+
+    config = {
+        "TRAKT_USERNAME": "benchmark",
+        "CLIENT_ID": "id",
+        "CLIENT_SECRET": "secret",
+        "TRAKT_BASE_URL": baseUrl,
+    }
+    config.update(configOverrides)
+    with open(os.path.join(stateDirectory, "config.json"), "w") as f:
+        json.dump(config, f)
+
+    # Credentials which won't expire during the benchmark, so no authentication is needed
+    with open(os.path.join(stateDirectory, "pytrakt.json"), "w") as f:
+        json.dump(
+            {
+                "CLIENT_ID": "id",
+                "CLIENT_SECRET": "secret",
+                "OAUTH_TOKEN": "token",
+                "OAUTH_REFRESH": "refresh",
+                "OAUTH_EXPIRES_AT": int(time.time()) + 30 * 24 * 60 * 60,
+            },
+            f,
+        )
+
+
+def benchmark(size, args, configOverrides):
+    backup = generateBackup(size, ambiguity=args.ambiguity, seed=args.seed)
+    server = FakeTraktServer(
+        backup,
+        latencySeconds=args.latency_ms / 1000,
+        getLimit=(args.get_limit, args.rate_limit_period),
+        postLimit=(args.post_limit, args.rate_limit_period),
+        rateLimitEvery=args.rate_limit_every,
+        invalidEvery=args.invalid_every,
+        unavailableEvery=args.unavailable_every,
+        missing=args.missing,
+        seed=args.seed,
+    ).start()
+
+    try:
+        with tempfile.TemporaryDirectory() as stateDirectory:
+            prepareStateDirectory(
+                stateDirectory, backup, server.baseUrl, configOverrides
+            )
+
+            importResult = runChild(
+                stateDirectory, "twee.json", args.stream, args.verbose
+            )
+            importCalls = dict(server.calls)
+            importConnections = server.connectionsCount
+            server.calls.clear()
+
+            resumeResult = runChild(
+                stateDirectory, "twee.json", args.stream, args.verbose
+            )
+            resumeCalls = dict(server.calls)
+    finally:
+        server.stop()
+
+    apiCalls = sum(
+        count
+        for endpoint, count in importCalls.items()
+        if endpoint.split(" ", 1)[1] not in ("rate-limited", "invalid", "unavailable")
+    )
+    return {
+        "episodes": size,
+        "syncedEpisodes": importResult["syncedEpisodes"],
+        "elapsedSeconds": importResult["elapsedSeconds"],
+        "episodesPerSecond": size / importResult["elapsedSeconds"],
+        "apiCalls": apiCalls,
+        "apiCallsPerEpisode": apiCalls / size,
+        "rateLimitedCalls": sum(
+            count
+            for endpoint, count in importCalls.items()
+            if "rate-limited" in endpoint
+        ),
+        "apiCallsByEndpoint": importCalls,
+        "connections": importConnections,
+        "peakMemoryMegabytes": importResult["peakMemoryMegabytes"],
+        "resumeSeconds": resumeResult["elapsedSeconds"],
+        "resumeApiCalls": sum(resumeCalls.values()),
+    }
+
+
+def printReport(results):
+    print(
+        f"{'episodes':>10} {'synced':>10} {'seconds':>9} {'eps/sec':>10} {'calls/ep':>9} "
+        f"{'429s':>6} {'conns':>6} {'peak MB':>9} {'resume s':>9} {'resume calls':>13}"
+    )
+    for result in results:
+        print(
+            f"{result['episodes']:>10} {result['syncedEpisodes']:>10} "
+            f"{result['elapsedSeconds']:>9.2f} {result['episodesPerSecond']:>10.1f} "
+            f"{result['apiCallsPerEpisode']:>9.4f} {result['rateLimitedCalls']:>6} "
+            f"{result['connections']:>6} "
+            f"{result['peakMemoryMegabytes']:>9.1f} {result['resumeSeconds']:>9.2f} "
+            f"{result['resumeApiCalls']:>13}"
+        )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        runImport(sys.argv[2], sys.argv[3], "--stream" in sys.argv[4:])
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the import against a local fake Trakt server."
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 100000],
+        help="numbers of watched episodes to benchmark (default: 1000 10000 100000)",
+    )
+    parser.add_argument(
+        "--latency-ms", type=float, default=0, help="latency added to every response"
+    )
+    parser.add_argument(
+        "--get-limit",
+        type=int,
+        default=100000,
+        help="GET requests allowed by the server per rate limit period",
+    )
+    parser.add_argument(
+        "--post-limit",
+        type=int,
+        default=100000,
+        help="POST requests allowed by the server per rate limit period",
+    )
+    parser.add_argument(
+        "--rate-limit-period",
+        type=int,
+        default=1,
+        help="length of the server's rate limit period, in seconds",
+    )
+    parser.add_argument(
+        "--rate-limit-every",
+        type=int,
+        default=0,
+        help="respond with 429 to every Nth request, regardless of the rate limit",
+    )
+    parser.add_argument(
+        "--invalid-every",
+        type=int,
+        default=0,
+        help="respond with an HTML page instead of JSON to every Nth request",
+    )
+    parser.add_argument(
+        "--unavailable-every",
+        type=int,
+        default=0,
+        help="respond with 503 to every Nth request",
+    )
+    parser.add_argument(
+        "--ambiguity",
+        type=float,
+        default=0.05,
+        help="fraction of shows with more than one matching Trakt show",
+    )
+    parser.add_argument(
+        "--missing",
+        type=float,
+        default=0.02,
+        help="fraction of seasons missing their last episode in Trakt",
+    )
+    parser.add_argument(
+        "--config",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="override a config.json value for the import (JSON values)",
+    )
+    parser.add_argument("--stream", action="store_true", help="import with --stream")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--json", metavar="PATH", help="also write the results here")
+    parser.add_argument(
+        "--verbose", action="store_true", help="show the output of the imports"
+    )
+    args = parser.parse_args()
+
+    configOverrides = {}
+    for override in args.config:
+        key, value = override.split("=", 1)
+        try:
+            configOverrides[key] = json.loads(value)
+        except json.decoder.JSONDecodeError:
+            configOverrides[key] = value
+
+    results = [benchmark(size, args, configOverrides) for size in args.sizes]
+    printReport(results)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
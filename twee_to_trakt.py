@@ -1,16 +1,42 @@
 #!/usr/bin/env python3
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import heapq
 import json
 import logging
 import os
+import queue
+import random
 import re
+import sqlite3
 import sys
+import threading
 import time
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse
 
+import requests
 import trakt.core
-from tinydb import Query, TinyDB
+from requests.adapters import HTTPAdapter
+from tinydb import TinyDB
 from trakt import init
 from trakt.tv import TVShow
+from trakt.utils import timestamp
+from urllib3.util.retry import Retry
+
+# Optional packages, which make reading large backups faster and use less memory
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Setup logger
 logging.basicConfig(
@@ -19,14 +45,57 @@ logging.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S",
 )
 
-# Adjust this value to increase/decrease your requests between episodes.
-# Make to remain within the rate limit: https://trakt.docs.apiary.io/#introduction/rate-limiting
-DELAY_BETWEEN_EPISODES_IN_SECONDS = 1
-
-# Create a database to keep track of completed processes
-database = TinyDB("localStorage.json")
-syncedEpisodesTable = database.table("SyncedEpisodes")
-userMatchedShowsTable = database.table("TweeTraktUserMatched")
+# Trakt's rate limits, which are used until Trakt reports its own limits in the response headers.
+# GET requests and other requests (POST, PUT and DELETE) have separate budgets:
+# https://trakt.docs.apiary.io/#introduction/rate-limiting
+RATE_LIMITS = {"GET": (1000, 300), "POST": (1, 1)}
+# How many times a request is retried after Trakt responds that the rate limit was hit
+RATE_LIMIT_MAX_RETRIES = 5
+
+# How long to wait for Trakt to accept a connection, and then to respond, in seconds
+REQUEST_TIMEOUT_SECONDS = (10, 60)
+# How many times a request is retried straight away when the connection fails, or Trakt's
+# server responds with an error which is likely to go away, and the base of the backoff
+# between those retries in seconds. POST requests are only retried this way when they
+# couldn't be sent, since they might have been applied already - the batches of history
+# are retried by the HistoryBatcher instead.
+TRANSPORT_MAX_RETRIES = 3
+TRANSPORT_RETRY_BACKOFF_SECONDS = 0.5
+TRANSPORT_RETRY_STATUSES = (502, 503, 504)
+
+# How many times an episode is tried when Trakt responds with errors, and how long to wait
+# before retrying it - the wait doubles after each attempt, up to the maximum
+RETRY_MAX_ATTEMPTS = 10
+RETRY_BASE_DELAY_SECONDS = 5
+RETRY_MAX_DELAY_SECONDS = 10 * 60
+
+# How many rows ahead of the current row the import starts fetching shows and seasons for
+PIPELINE_LOOKAHEAD_ROWS = 1000
+
+# Search results are scored by how similar their title is to the Twee title, from 0 to 1, plus
+# bonuses for agreeing on the year and the number of seasons. Results below the minimum
+# similarity aren't considered at all, and the best result is picked automatically when its
+# score is at least the threshold, and ahead of the next best result by at least the margin.
+TITLE_MATCH_MIN_SIMILARITY = 0.5
+TITLE_MATCH_ACCEPT_SCORE = 0.75
+TITLE_MATCH_ACCEPT_MARGIN = 0.25
+
+# How often the progress of the import (and the metrics file, if there is one) is updated
+PROGRESS_INTERVAL_SECONDS = 10
+# Upper bounds of the buckets which the timings are counted in, in seconds
+METRICS_LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# The local database keeps track of completed processes. It used to be a TinyDB file,
+# which is still migrated from when it exists.
+LOCAL_STORAGE_PATH = "localStorage.json"
+# Paths of the database for each of the available storage backends
+STORAGE_PATHS = {"sqlite": "localStorage.db", "journal": "localStorage.jsonl"}
+
+# Resolved Trakt shows used to be cached in a separate file, which is still migrated from
+# when it exists
+SHOW_CACHE_PATH = os.path.join(os.path.dirname(LOCAL_STORAGE_PATH), "showCache.json")
+# How long to wait for other imports which are writing to the shared show cache
+SHARED_SHOW_CACHE_TIMEOUT_SECONDS = 60
 
 
 class Expando(object):
@@ -56,6 +125,28 @@ def getConfiguration():
     configEx.CLIENT_ID = data["CLIENT_ID"]
     configEx.CLIENT_SECRET = data["CLIENT_SECRET"]
     configEx.GDPR_WORKSPACE_PATH = data.get("GDPR_WORKSPACE_PATH", ".")
+    # How long a resolved show is trusted before Trakt is searched again (default: 30 days)
+    configEx.SHOW_CACHE_TTL_HOURS = data.get("SHOW_CACHE_TTL_HOURS", 24 * 30)
+    # How many episodes are sent to Trakt's history in a single request, and how long
+    # an episode may wait in a partially filled batch before it's sent anyway
+    configEx.SYNC_BATCH_SIZE = data.get("SYNC_BATCH_SIZE", 500)
+    configEx.SYNC_FLUSH_INTERVAL_SECONDS = data.get("SYNC_FLUSH_INTERVAL_SECONDS", 60)
+    # Which backend to store the local database with, either 'sqlite' or 'journal'
+    configEx.STORAGE_BACKEND = data.get("STORAGE_BACKEND", "sqlite")
+    # How many threads resolve shows, and how many fetch seasons, at the same time
+    configEx.WORKER_THREADS = data.get("WORKER_THREADS", 4)
+    # How long the seasons and episodes of a show are trusted before they're requested again,
+    # so that newly aired episodes are picked up (default: 7 days)
+    configEx.SEASON_INDEX_TTL_HOURS = data.get("SEASON_INDEX_TTL_HOURS", 24 * 7)
+    # How long a show which couldn't be matched, or an episode which couldn't be found, is
+    # skipped before it's tried again (default: 7 days)
+    configEx.FAILURE_CACHE_TTL_HOURS = data.get("FAILURE_CACHE_TTL_HOURS", 24 * 7)
+    # An SQLite database of resolved shows which is shared with other imports (e.g other
+    # accounts imported by batch_import.py), on top of the show cache (default: not shared)
+    configEx.SHARED_SHOW_CACHE_PATH = data.get("SHARED_SHOW_CACHE_PATH")
+    # The address of Trakt's API, e.g to import against a local stand-in server
+    # (default: PyTrakt's address of the API)
+    configEx.TRAKT_BASE_URL = data.get("TRAKT_BASE_URL")
 
     CONFIG_SINGLETON = configEx
 
@@ -65,12 +156,861 @@ def getConfiguration():
 config = getConfiguration()
 
 
+# Counters and timings for every stage of the import, so it's possible to tell where the time
+# goes: each Trakt endpoint, the caches, the local database, and time spent waiting. They're
+# shared by all of the threads, and can be saved as JSON or in Prometheus' text format.
+
+
+class Metrics(object):
+    def __init__(self, buckets):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.startTime = time.time()
+        # Both are keyed by the name of the metric, and its labels
+        self.counters = {}
+        self.histograms = {}
+
+    @staticmethod
+    def makeKey(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def increment(self, name, value=1, **labels):
+        key = self.makeKey(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    # Count a timing in every bucket that it fits in, like Prometheus' histograms
+    def observe(self, name, seconds, **labels):
+        key = self.makeKey(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = {"count": 0, "sum": 0.0, "buckets": [0] * len(self.buckets)}
+                self.histograms[key] = histogram
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram["buckets"][index] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        startTime = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - startTime, **labels)
+
+    def getCounter(self, name, **labels):
+        with self.lock:
+            return sum(
+                value
+                for (counterName, counterLabels), value in self.counters.items()
+                if counterName == name and set(labels.items()) <= set(counterLabels)
+            )
+
+    def toJson(self):
+        with self.lock:
+            return {
+                "startTime": self.startTime,
+                "elapsedSeconds": time.time() - self.startTime,
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+                "histograms": [
+                    {
+                        "name": name,
+                        "labels": dict(labels),
+                        "count": histogram["count"],
+                        "sum": histogram["sum"],
+                        "buckets": dict(
+                            zip(map(str, self.buckets), histogram["buckets"])
+                        ),
+                    }
+                    for (name, labels), histogram in sorted(self.histograms.items())
+                ],
+            }
+
+    def toPrometheus(self):
+        def formatLabels(labels, extraLabels=()):
+            labels = list(labels) + list(extraLabels)
+            if not labels:
+                return ""
+            return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+        lines = []
+        with self.lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE twee_to_trakt_{name}_total counter")
+                for (counterName, labels), value in sorted(self.counters.items()):
+                    if counterName == name:
+                        lines.append(
+                            f"twee_to_trakt_{name}_total{formatLabels(labels)} {value}"
+                        )
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE twee_to_trakt_{name} histogram")
+                for (histogramName, labels), histogram in sorted(
+                    self.histograms.items()
+                ):
+                    if histogramName != name:
+                        continue
+                    for bound, count in zip(self.buckets, histogram["buckets"]):
+                        lines.append(
+                            f"twee_to_trakt_{name}_bucket{formatLabels(labels, [('le', bound)])} {count}"
+                        )
+                    lines.append(
+                        f"twee_to_trakt_{name}_bucket{formatLabels(labels, [('le', '+Inf')])} {histogram['count']}"
+                    )
+                    lines.append(
+                        f"twee_to_trakt_{name}_sum{formatLabels(labels)} {histogram['sum']}"
+                    )
+                    lines.append(
+                        f"twee_to_trakt_{name}_count{formatLabels(labels)} {histogram['count']}"
+                    )
+        return "\n".join(lines) + "\n"
+
+    # Save the metrics in Prometheus' text format when the file ends in '.prom', and as
+    # JSON otherwise. The file is replaced in one go, so it can be read at any time.
+    def save(self, path):
+        temporaryPath = path + ".tmp"
+        with open(temporaryPath, "w") as f:
+            if path.endswith(".prom"):
+                f.write(self.toPrometheus())
+            else:
+                json.dump(self.toJson(), f, indent=2)
+        os.replace(temporaryPath, path)
+
+    # Log where the time went, by Trakt endpoint and by stage of the import
+    def logSummary(self):
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+        for (name, labels), histogram in histograms:
+            labels = dict(labels)
+            if name == "trakt_request_seconds":
+                description = f"{labels['method']} {labels['endpoint']}"
+            elif name == "stage_seconds":
+                description = labels["stage"]
+            else:
+                continue
+            logging.info(
+                f"{description}: {histogram['count']} times, {histogram['sum']:.1f} seconds in total, "
+                + f"{1000 * histogram['sum'] / histogram['count']:.0f} ms on average."
+            )
+        for cache in ("show_mapping", "show_cache", "season_index"):
+            hits = self.getCounter("cache_lookups", cache=cache, result="hit")
+            misses = self.getCounter("cache_lookups", cache=cache, result="miss")
+            if hits + misses:
+                logging.info(
+                    f"{cache}: {100 * hits / (hits + misses):.0f}% of {hits + misses} lookups were hits."
+                )
+        logging.info(
+            f"Waited {self.getCounter('throttled_seconds'):.1f} seconds for Trakt's rate limit, "
+            + f"and {self.getCounter('sleep_seconds'):.1f} seconds before retrying."
+        )
+
+
+metrics = Metrics(METRICS_LATENCY_BUCKETS)
+
+
+# The local database is made up of named tables, where each document is stored under a
+# unique key. Writes are only made durable once they're committed, so that many writes
+# can share a single commit. Two backends are available: an SQLite database (the default),
+# and an append-only journal file.
+
+
+class SqliteStorage(object):
+    def __init__(self, path, timeout=5):
+        # The connection is shared between threads, but only used by one at a time
+        self.connection = sqlite3.connect(
+            path, timeout=timeout, check_same_thread=False
+        )
+        self.lock = threading.RLock()
+        # Write-ahead logging keeps the database intact if the program is killed mid-write
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS documents "
+            "(tableName TEXT, key TEXT, document TEXT, PRIMARY KEY (tableName, key))"
+        )
+        self.connection.commit()
+
+    def all(self, tableName):
+        with self.lock:
+            cursor = self.connection.execute(
+                "SELECT key, document FROM documents WHERE tableName = ?", (tableName,)
+            )
+            return {key: json.loads(document) for key, document in cursor}
+
+    def get(self, tableName, key):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT document FROM documents WHERE tableName = ? AND key = ?",
+                (tableName, key),
+            ).fetchone()
+            return None if row is None else json.loads(row[0])
+
+    def put(self, tableName, key, document):
+        self.putMany(tableName, [(key, document)])
+
+    def putMany(self, tableName, items):
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO documents VALUES (?, ?, ?)",
+                [(tableName, key, json.dumps(document)) for key, document in items],
+            )
+
+    def delete(self, tableName, key):
+        with self.lock:
+            self.connection.execute(
+                "DELETE FROM documents WHERE tableName = ? AND key = ?",
+                (tableName, key),
+            )
+
+    def commit(self):
+        with self.lock, metrics.timer("stage_seconds", stage="storage_commit"):
+            self.connection.commit()
+
+    def rollback(self):
+        with self.lock:
+            self.connection.rollback()
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+
+class JournalStorage(object):
+    def __init__(self, path):
+        self.path = path
+        self.tables = {}
+        self.pendingLines = []
+        self.lock = threading.RLock()
+        journalLength = 0
+        isIncomplete = False
+
+        # Replay the journal to rebuild the tables
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.decoder.JSONDecodeError:
+                        # The last line can be incomplete if the program was killed
+                        # whilst writing it, in which case the entry was never committed
+                        logging.warning(
+                            f"Ignoring an incomplete entry at the end of '{path}'."
+                        )
+                        isIncomplete = True
+                        break
+                    table = self.tables.setdefault(entry["table"], {})
+                    if entry.get("deleted"):
+                        table.pop(entry["key"], None)
+                    else:
+                        table[entry["key"]] = entry["document"]
+                    journalLength += 1
+
+        # Compact the journal when most of its entries have been overwritten or deleted,
+        # or when the incomplete entry needs to be removed before appending to it
+        if isIncomplete or journalLength > 2 * sum(
+            len(table) for table in self.tables.values()
+        ):
+            self.compact()
+
+        self.file = open(path, "a")
+
+    def all(self, tableName):
+        with self.lock:
+            return dict(self.tables.get(tableName, {}))
+
+    def get(self, tableName, key):
+        with self.lock:
+            return self.tables.get(tableName, {}).get(key)
+
+    def put(self, tableName, key, document):
+        self.putMany(tableName, [(key, document)])
+
+    def putMany(self, tableName, items):
+        with self.lock:
+            table = self.tables.setdefault(tableName, {})
+            for key, document in items:
+                table[key] = document
+                self.pendingLines.append(
+                    json.dumps({"table": tableName, "key": key, "document": document})
+                )
+
+    def delete(self, tableName, key):
+        with self.lock:
+            self.tables.get(tableName, {}).pop(key, None)
+            self.pendingLines.append(
+                json.dumps({"table": tableName, "key": key, "deleted": True})
+            )
+
+    def commit(self):
+        with self.lock, metrics.timer("stage_seconds", stage="storage_commit"):
+            if not self.pendingLines:
+                return
+            self.file.write("\n".join(self.pendingLines) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.pendingLines = []
+
+    def compact(self):
+        # Write the current tables to a new journal, then swap it into place
+        temporaryPath = self.path + ".tmp"
+        with open(temporaryPath, "w") as f:
+            for tableName, table in self.tables.items():
+                for key, document in table.items():
+                    f.write(
+                        json.dumps(
+                            {"table": tableName, "key": key, "document": document}
+                        )
+                        + "\n"
+                    )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporaryPath, self.path)
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            self.file.close()
+
+
+STORAGE_BACKENDS = {"sqlite": SqliteStorage, "journal": JournalStorage}
+
+
+# Copy the tables from the old TinyDB file into the new storage. This only happens once,
+# the old file is left in place in case it's needed again.
+
+
+def migrateLocalStorage(storage, legacyPath):
+    if not os.path.exists(legacyPath) or "migrated" in storage.all("Migrations"):
+        return
+
+    logging.info(f"Migrating the local database from '{legacyPath}'...")
+    legacyDatabase = TinyDB(legacyPath)
+    storage.putMany(
+        "SyncedEpisodes",
+        [
+            (document["episodeId"], {})
+            for document in legacyDatabase.table("SyncedEpisodes").all()
+        ],
+    )
+    userMatchedShowsItems = {}
+    for document in legacyDatabase.table("TweeTraktUserMatched").all():
+        userMatchedShowsItems.setdefault(document["ShowName"], dict(document))
+    storage.putMany("TweeTraktUserMatched", userMatchedShowsItems.items())
+    storage.put("Migrations", "migrated", {"from": legacyPath, "at": time.time()})
+    storage.commit()
+    legacyDatabase.close()
+
+
+storage = STORAGE_BACKENDS[config.STORAGE_BACKEND](
+    STORAGE_PATHS[config.STORAGE_BACKEND]
+)
+migrateLocalStorage(storage, LOCAL_STORAGE_PATH)
+
+# The synthetic episode IDs are kept in memory as integers built from their bytes, which
+# take up less memory than the strings whilst still being unique. The local database still
+# stores them as strings.
+
+
+def packEpisodeId(episodeId):
+    return int.from_bytes(episodeId.encode(), "big")
+
+
+def unpackEpisodeId(episodeKey):
+    return episodeKey.to_bytes((episodeKey.bit_length() + 7) // 8, "big").decode()
+
+
+# The tables are loaded into memory once, so checking whether an episode has been
+# imported (or a show has been matched by the user) doesn't need to query the storage.
+# The indexes below are kept up to date whenever the tables are written to.
+syncedEpisodeIds = {
+    packEpisodeId(episodeId) for episodeId in storage.all("SyncedEpisodes")
+}
+userMatchedShows = storage.all("TweeTraktUserMatched")
+showMappings = storage.all("ShowMappings")
+deferredSelections = storage.all("DeferredSelections")
+
+
+def isEpisodeSynced(episodeKey):
+    return episodeKey in syncedEpisodeIds
+
+
+def markEpisodesSynced(episodeKeys):
+    episodeKeys = [
+        episodeKey for episodeKey in episodeKeys if episodeKey not in syncedEpisodeIds
+    ]
+    with metrics.timer("stage_seconds", stage="mark_synced"):
+        storage.putMany(
+            "SyncedEpisodes",
+            [(unpackEpisodeId(episodeKey), {}) for episodeKey in episodeKeys],
+        )
+        # The episodes are already in Trakt's history, so commit straight away
+        storage.commit()
+    syncedEpisodeIds.update(episodeKeys)
+
+
+# Selections which were made by older versions of the script, stored as an index into the
+# search results. They're only read, and replaced by show mappings as they're used. A
+# selection which doesn't fit the search results anymore is forgotten.
+
+
+def getUserMatchedShow(showName):
+    return userMatchedShows.get(showName)
+
+
+def forgetUserMatchedShow(showName):
+    if userMatchedShows.pop(showName, None) is not None:
+        storage.delete("TweeTraktUserMatched", showName)
+        storage.commit()
+
+
+# Each Twee show (by its SeriesId) is mapped to the Trakt show that it was matched to, either
+# automatically or by the user, or to nothing when the user chose to skip the show. The
+# mapping stores the Trakt IDs, so a mapped show doesn't need to be searched for at all.
+
+
+def getShowMapping(seriesId):
+    return showMappings.get(seriesId)
+
+
+def saveShowMapping(seriesId, showName, traktShowObj, source):
+    document = {
+        "SeriesId": seriesId,
+        "ShowName": showName,
+        "SkipShow": traktShowObj is None,
+        "Source": source,
+    }
+    if traktShowObj is not None:
+        document["title"] = traktShowObj.title
+        document["year"] = traktShowObj.year
+        document["ids"] = traktShowObj.ids["ids"]
+    storage.put("ShowMappings", seriesId, document)
+    # The show no longer needs to wait for a selection
+    if deferredSelections.pop(seriesId, None) is not None:
+        storage.delete("DeferredSelections", seriesId)
+    storage.commit()
+    showMappings[seriesId] = document
+
+
+# A Twee show which needs the user to pick from the search results, when the prompts are
+# deferred (see --defer-prompts). The search results are stored along with it, so the user
+# can be prompted by a later run without searching for the show again.
+
+
+def getDeferredSelection(seriesId):
+    return deferredSelections.get(seriesId)
+
+
+def saveDeferredSelection(seriesId, showName, year, showsWithSameName):
+    document = {
+        "SeriesId": seriesId,
+        "ShowName": showName,
+        "Year": year,
+        "Candidates": [
+            {"title": show.title, "year": show.year, "ids": show.ids["ids"]}
+            for show in showsWithSameName
+        ],
+        "DeferredAt": time.time(),
+    }
+    storage.put("DeferredSelections", seriesId, document)
+    storage.commit()
+    deferredSelections[seriesId] = document
+
+
+# Forget the mappings to a Trakt show, or of a Twee show, so that the show is searched for again
+
+
+def forgetShowMappings(showName=None, slug=None):
+    for seriesId, document in list(showMappings.items()):
+        if (showName is not None and document["ShowName"] == showName) or (
+            slug is not None and document.get("ids", {}).get("slug") == slug
+        ):
+            storage.delete("ShowMappings", seriesId)
+            del showMappings[seriesId]
+    # Stored search results of the show are stale as well
+    if showName is not None:
+        for seriesId, document in list(deferredSelections.items()):
+            if document["ShowName"] == showName:
+                storage.delete("DeferredSelections", seriesId)
+                del deferredSelections[seriesId]
+    storage.commit()
+
+
+# Rebuild a show from its stored Trakt IDs - passing the attributes to TVShow
+# means that it won't request the show from the Trakt API again
+
+
+def buildShow(title, year, ids):
+    return TVShow(
+        title,
+        slug=ids["slug"],
+        year=year,
+        trakt=ids["trakt"],
+        imdb=ids["imdb"],
+        tmdb=ids["tmdb"],
+        tvdb=ids["tvdb"],
+    )
+
+
+# Searching Trakt for a show is the most expensive part of the import, and it
+# used to happen for every single episode. The show cache remembers which Trakt
+# show a Twee title (and year) was resolved to, both in memory and in the local
+# database, so the search only happens once per show - even across restarts. Optionally,
+# the matches are also shared with other imports through an SQLite database, which every
+# import can read from and write to at the same time.
+
+
+class ShowCache(object):
+    def __init__(self, storage, ttlHours, sharedStorage=None):
+        self.storage = storage
+        self.ttlSeconds = ttlHours * 60 * 60
+        self.entries = storage.all("ShowCache")
+        # The cache is shared by the threads which resolve shows
+        self.lock = threading.RLock()
+        self.sharedStorage = sharedStorage
+
+    # The key is built from the title and year produced by getYearFromTitle, with the
+    # title normalised so that differences in case and whitespace still hit the cache
+    @staticmethod
+    def makeKey(title, year):
+        return f"{' '.join(title.split()).casefold()}|{year}"
+
+    def get(self, title, year):
+        key = self.makeKey(title, year)
+        with self.lock:
+            entry = self.entries.get(key)
+            # The show might have been resolved by another import in the meantime
+            if entry is None and self.sharedStorage is not None:
+                try:
+                    entry = self.sharedStorage.get("ShowCache", key)
+                except sqlite3.OperationalError as e:
+                    logging.warning(f"The shared show cache couldn't be read: {e}")
+                if entry is not None:
+                    self.entries[key] = entry
+            if entry is None:
+                return None
+
+            # Drop the entry if it has outlived the configured TTL
+            if time.time() - entry["cachedAt"] > self.ttlSeconds:
+                if self.entries.pop(key, None) is not None:
+                    self.storage.delete("ShowCache", key)
+                    self.storage.commit()
+                return None
+
+        return buildShow(entry["title"], entry["year"], entry["ids"])
+
+    def put(self, title, year, show):
+        key = self.makeKey(title, year)
+        entry = {
+            "title": show.title,
+            "year": show.year,
+            "ids": show.ids["ids"],
+            "cachedAt": time.time(),
+        }
+        with self.lock:
+            self.entries[key] = entry
+            self.storage.put("ShowCache", key, entry)
+            self.storage.commit()
+            self.updateSharedStorage(
+                lambda sharedStorage: sharedStorage.put("ShowCache", key, entry)
+            )
+
+    # Remove entries from the cache. Without any arguments the whole cache is cleared,
+    # otherwise only entries for the given Twee title (optionally with a year), or for
+    # the given Trakt slug are removed.
+    def invalidate(self, title=None, year=None, slug=None):
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if self.isInvalidated(key, entry, title, year, slug):
+                    del self.entries[key]
+                    self.storage.delete("ShowCache", key)
+            self.storage.commit()
+
+            def deleteEntries(sharedStorage):
+                for key, entry in sharedStorage.all("ShowCache").items():
+                    if self.isInvalidated(key, entry, title, year, slug):
+                        sharedStorage.delete("ShowCache", key)
+
+            self.updateSharedStorage(deleteEntries)
+
+    # Write to the shared show cache. The other imports may hold its lock for longer than
+    # the timeout, in which case this import carries on without updating it.
+    def updateSharedStorage(self, update):
+        if self.sharedStorage is None:
+            return
+        try:
+            update(self.sharedStorage)
+            self.sharedStorage.commit()
+        except sqlite3.OperationalError as e:
+            logging.warning(f"The shared show cache couldn't be updated: {e}")
+            self.sharedStorage.rollback()
+
+    def isInvalidated(self, key, entry, title, year, slug):
+        if title is None and slug is None:
+            return True
+        if title is not None and key.startswith(self.makeKey(title, "")):
+            return year is None or key == self.makeKey(title, year)
+        return slug is not None and entry["ids"]["slug"] == slug
+
+
+# Copy the entries from the old show cache file into the local database. Like the TinyDB
+# file, this only happens once and the old file is left in place.
+
+
+def migrateShowCache(storage, legacyPath):
+    if not os.path.exists(legacyPath) or "showCache" in storage.all("Migrations"):
+        return
+
+    try:
+        with open(legacyPath) as f:
+            entries = json.load(f)
+    except (OSError, json.decoder.JSONDecodeError):
+        logging.warning(
+            f"The show cache '{legacyPath}' could not be read, so it will be rebuilt."
+        )
+        entries = {}
+    storage.putMany("ShowCache", entries.items())
+    storage.put("Migrations", "showCache", {"from": legacyPath, "at": time.time()})
+    storage.commit()
+
+
+migrateShowCache(storage, SHOW_CACHE_PATH)
+showCache = ShowCache(
+    storage,
+    config.SHOW_CACHE_TTL_HOURS,
+    (
+        SqliteStorage(config.SHARED_SHOW_CACHE_PATH, SHARED_SHOW_CACHE_TIMEOUT_SECONDS)
+        if config.SHARED_SHOW_CACHE_PATH
+        else None
+    ),
+)
+
+
+# Every request to Trakt is paced by a token bucket, which allows bursts up to the limit
+# and then refills at the rate Trakt allows. Trakt reports the limit and the remaining
+# budget in the 'X-Ratelimit' header, and how long to wait in 'Retry-After' when the
+# limit has been hit, so the buckets adapt to whatever Trakt asks for.
+
+
+class TokenBucket(object):
+    def __init__(self, limit, periodSeconds):
+        self.lock = threading.Lock()
+        self.capacity = limit
+        self.refillRate = limit / periodSeconds
+        self.tokens = limit
+        self.updatedAt = time.monotonic()
+        self.blockedUntil = 0
+
+    def refill(self, now):
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updatedAt) * self.refillRate
+        )
+        self.updatedAt = now
+
+    # Wait until a request can be made, and then take a token for it. Returns how long
+    # it had to wait.
+    def acquire(self):
+        waitedSeconds = 0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.refill(now)
+                if now >= self.blockedUntil and self.tokens >= 1:
+                    self.tokens -= 1
+                    return waitedSeconds
+                waitSeconds = max(
+                    self.blockedUntil - now, (1 - self.tokens) / self.refillRate
+                )
+            time.sleep(waitSeconds)
+            waitedSeconds += waitSeconds
+
+    def update(self, limit, periodSeconds, remaining):
+        with self.lock:
+            self.refill(time.monotonic())
+            self.capacity = limit
+            self.refillRate = limit / periodSeconds
+            self.tokens = min(self.tokens, remaining)
+
+    # Don't hand out any tokens for the given amount of time
+    def block(self, seconds):
+        with self.lock:
+            self.blockedUntil = max(self.blockedUntil, time.monotonic() + seconds)
+
+
+class RateLimiter(object):
+    def __init__(self, rateLimits):
+        self.buckets = {
+            name: TokenBucket(limit, periodSeconds)
+            for name, (limit, periodSeconds) in rateLimits.items()
+        }
+
+    def getBucket(self, method):
+        return self.buckets["GET" if method.upper() == "GET" else "POST"]
+
+    def acquire(self, method):
+        return self.getBucket(method).acquire()
+
+    def block(self, method, seconds):
+        self.getBucket(method).block(seconds)
+
+    def update(self, method, response):
+        bucket = self.getBucket(method)
+        rateLimitHeader = response.headers.get("X-Ratelimit")
+        if rateLimitHeader:
+            try:
+                rateLimit = json.loads(rateLimitHeader)
+                bucket.update(
+                    rateLimit["limit"], rateLimit["period"], rateLimit["remaining"]
+                )
+                # When the budget has run out, wait until Trakt resets it
+                if rateLimit["remaining"] <= 0 and rateLimit.get("until"):
+                    until = datetime.fromisoformat(
+                        rateLimit["until"].replace("Z", "+00:00")
+                    )
+                    bucket.block((until - datetime.now(timezone.utc)).total_seconds())
+            except (ValueError, KeyError, TypeError, ZeroDivisionError):
+                logging.debug(
+                    f"Ignoring an invalid X-Ratelimit header: {rateLimitHeader}"
+                )
+
+        if response.status_code == 429:
+            bucket.block(getRetryAfterSeconds(response))
+
+
+# Name the endpoint which a URL requests, with the IDs, slugs and numbers replaced, so the
+# requests can be grouped by endpoint (e.g 'shows/:id/seasons')
+
+
+def getEndpointName(url):
+    segments = urlparse(url).path.strip("/").split("/")
+    for index in range(1, len(segments)):
+        if (
+            segments[index - 1] in ("shows", "seasons", "episodes")
+            or segments[index].isdigit()
+        ):
+            segments[index] = ":id"
+    return "/".join(segments)
+
+
+def getRetryAfterSeconds(response, default=1):
+    try:
+        return float(response.headers.get("Retry-After", default))
+    except (TypeError, ValueError):
+        return default
+
+
+# How long to wait before the given attempt, with a random jitter so that the retries
+# are spread out rather than all hitting Trakt at the same moment
+
+
+def getBackoffSeconds(attempts):
+    delaySeconds = min(
+        RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2 ** (attempts - 1)
+    )
+    return random.uniform(delaySeconds / 2, delaySeconds)
+
+
+# The session which PyTrakt uses for every request, so that all of them are paced by the
+# rate limiter. When Trakt responds that the rate limit was hit, the request is retried
+# once Trakt allows it. The session is shared by every thread of the import, so it keeps
+# enough connections alive for all of them, rather than connecting to Trakt again for
+# each request, and it retries requests which fail because of a connection or server error.
+
+
+class RateLimitedSession(requests.Session):
+    def __init__(self, rateLimiter, maxRetries, poolSize=10):
+        super().__init__()
+        self.rateLimiter = rateLimiter
+        self.maxRetries = maxRetries
+
+        transportRetry = Retry(
+            total=TRANSPORT_MAX_RETRIES,
+            backoff_factor=TRANSPORT_RETRY_BACKOFF_SECONDS,
+            status_forcelist=TRANSPORT_RETRY_STATUSES,
+            # Otherwise a 429 would be retried here too, behind the back of the rate limiter
+            respect_retry_after_header=False,
+            # The last response is handed back, so PyTrakt raises its usual errors for it
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=poolSize, max_retries=transportRetry
+        )
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+        # Responses are compressed, which requests decompresses on the fly
+        self.headers["Accept-Encoding"] = "gzip, deflate"
+
+    def request(self, method, url, *args, **kwargs):
+        method = method.upper()
+        endpoint = getEndpointName(url)
+        retries = 0
+        while True:
+            throttledSeconds = self.rateLimiter.acquire(method)
+            if throttledSeconds:
+                metrics.increment("throttled_seconds", throttledSeconds, method=method)
+            with metrics.timer(
+                "trakt_request_seconds", method=method, endpoint=endpoint
+            ):
+                response = super().request(
+                    method,
+                    url,
+                    *args,
+                    timeout=kwargs.pop("timeout", REQUEST_TIMEOUT_SECONDS),
+                    **kwargs,
+                )
+            metrics.increment(
+                "trakt_requests",
+                method=method,
+                endpoint=endpoint,
+                status=response.status_code,
+            )
+            self.rateLimiter.update(method, response)
+            if response.status_code != 429 or retries >= self.maxRetries:
+                return response
+
+            retries += 1
+            metrics.increment("rate_limit_retries", method=method)
+            logging.info(
+                f"Trakt's API rate limit was hit, retrying in {getRetryAfterSeconds(response)} seconds "
+                f"(attempt {retries}/{self.maxRetries})..."
+            )
+
+
+# Point PyTrakt at another address for Trakt's API. PyTrakt appends the endpoints straight
+# onto the address, so it has to end with a slash.
+
+
+def useTraktBaseUrl(baseUrl):
+    trakt.core.BASE_URL = baseUrl.rstrip("/") + "/"
+
+
+rateLimiter = RateLimiter(RATE_LIMITS)
+# Each thread which resolves shows or fetches seasons, the HistoryBatcher, and the main
+# thread can all be waiting for a response at the same time
+trakt.core.session = RateLimitedSession(
+    rateLimiter, RATE_LIMIT_MAX_RETRIES, poolSize=2 * config.WORKER_THREADS + 2
+)
+if config.TRAKT_BASE_URL:
+    useTraktBaseUrl(config.TRAKT_BASE_URL)
+
+
+# Set the method of authentication, and where PyTrakt stores the credentials
+
+
+def useTraktAuth():
+    trakt.core.AUTH_METHOD = trakt.core.OAUTH_AUTH
+    trakt.core.CONFIG_PATH = "pytrakt.json"
+
+
 def initTraktAuth():
+    useTraktAuth()
     if isAuthenticated():
         return True
-    # Set the method of authentication
-    trakt.core.AUTH_METHOD = trakt.core.OAUTH_AUTH
-    trakt.core.CONFIG_PATH = "pytrakt.json"
     return init(
         config.TRAKT_USERNAME,
         store=True,
@@ -105,47 +1045,133 @@ def getYearFromTitle(title):
         return ex
 
 
-# Shows in Twee are often different to Trakt.TV - in order to improve results and automation,
-# calculate how many words are in the title, and return true if more than 50% of the title is a match,
-# It seems to improve automation, and reduce manual selection....
-
-
-def checkTitleNameMatch(tweeTitle, traktTitle):
-    # If the name is a complete match, then don't bother comparing them!
-    if tweeTitle == traktTitle:
-        return True
-
-    # Split the Twee title
-    tweeTitleSplit = tweeTitle.split()
-
-    # Create an array of words which are found in the Trakt title
-    wordsMatched = []
+# Shows in Twee are often named a little differently to Trakt.TV, so the search results are
+# scored rather than compared word by word. Each title is normalised and split into a set of
+# words once, and the sets are compared by how many of their words they share. Results which
+# first aired in a different year are left out, and when the titles and years can't tell the
+# results apart, the number of seasons in Trakt is compared with the seasons watched in Twee.
+
+
+class TitleMatcher(object):
+    ARTICLES = frozenset(("the", "a", "an"))
+
+    def __init__(self, minSimilarity, acceptScore, acceptMargin):
+        self.minSimilarity = minSimilarity
+        self.acceptScore = acceptScore
+        self.acceptMargin = acceptMargin
+        # The words of every title which has been seen, so each is only split once
+        self.titleWords = {}
+
+    def getWords(self, title):
+        words = self.titleWords.get(title)
+        if words is None:
+            normalised = title.casefold().replace("&", " and ").replace("'", "")
+            words = frozenset(re.sub(r"[^\w]+", " ", normalised).split())
+            # Leave out articles, unless that leaves nothing
+            words = words - self.ARTICLES or words
+            self.titleWords[title] = words
+        return words
+
+    def getSimilarity(self, tweeTitle, traktTitle):
+        tweeWords = self.getWords(tweeTitle)
+        traktWords = self.getWords(traktTitle)
+        if not tweeWords or not traktWords:
+            return 0.0
+        return len(tweeWords & traktWords) / len(tweeWords | traktWords)
+
+    # Score a search result, or return None when it can't be the show. The year is -1 and
+    # the number of seasons is None when they aren't known.
+    def score(self, name, year, show, seasonsCount=None, showSeasonsCount=None):
+        score = self.getSimilarity(name, show.title)
+        if score < self.minSimilarity:
+            return None
 
-    # Go through each word of the Twee title, and check if it's in the Trakt title
-    for word in tweeTitleSplit:
-        if word in traktTitle:
-            wordsMatched.append(word)
+        if year > 0 and show.year:
+            yearDifference = abs(show.year - year)
+            if yearDifference > 1:
+                return None
+            # Twee and Trakt sometimes disagree by a year, e.g when a show premiered abroad
+            score += 0.3 if yearDifference == 0 else 0.1
+
+        if seasonsCount and showSeasonsCount is not None:
+            # A show can't have fewer seasons in Trakt than have been watched in Twee
+            if showSeasonsCount < seasonsCount:
+                score -= 0.5
+            elif showSeasonsCount == seasonsCount:
+                score += 0.25
+        return score
+
+    # Score the search results, returning the ones which could be the show from best to worst
+    def rank(self, name, year, shows, seasonsCount=None, getSeasonsCount=None):
+        ranked = []
+        for show in shows:
+            score = self.score(name, year, show)
+            if score is not None:
+                ranked.append((score, show))
+        ranked.sort(key=lambda item: item[0], reverse=True)
+
+        # The seasons are only requested for the results which are too close to call
+        if seasonsCount and getSeasonsCount is not None and len(ranked) > 1:
+            if not self.isConfident(ranked):
+                bestScore = ranked[0][0]
+                for index, (score, show) in enumerate(ranked):
+                    if bestScore - score < self.acceptMargin:
+                        showSeasonsCount = getSeasonsCount(show)
+                        ranked[index] = (
+                            self.score(
+                                name, year, show, seasonsCount, showSeasonsCount
+                            ),
+                            show,
+                        )
+                ranked.sort(key=lambda item: item[0], reverse=True)
+        return ranked
+
+    # Whether the best result is good enough, and far enough ahead of the rest, to be picked
+    # without asking the user. A result is always picked when it's the only one left.
+    def isConfident(self, ranked):
+        if len(ranked) <= 1:
+            return len(ranked) == 1
+        return (
+            ranked[0][0] >= self.acceptScore
+            and ranked[0][0] - ranked[1][0] >= self.acceptMargin
+        )
 
-    # Then calculate what percentage of words matched
-    quotient = len(wordsMatched) / len(traktTitle.split())
-    percentage = quotient * 100
 
-    # If more than 50% of words in the Twee title exist in the Trakt title,
-    # then return the title as a possibility to use
-    return percentage > 50
+titleMatcher = TitleMatcher(
+    TITLE_MATCH_MIN_SIMILARITY, TITLE_MATCH_ACCEPT_SCORE, TITLE_MATCH_ACCEPT_MARGIN
+)
 
 
 # Using Twee data (Name of Show, Season No and Episode) - find the corresponding show
 # in Trakt.TV either by automation, or asking the user to confirm.
 
 
-def getShowByName(name, seasonNo, episodeNo, tvShowYear):
+def getShowByName(
+    name,
+    seasonNo,
+    episodeNo,
+    tvShowYear,
+    seriesId=None,
+    interactive=True,
+    seasonsCount=None,
+):
+    # If the Twee show has already been matched (or skipped), then use the stored Trakt IDs
+    mapping = getShowMapping(seriesId) if seriesId is not None else None
+    metrics.increment(
+        "cache_lookups",
+        cache="show_mapping",
+        result="miss" if mapping is None else "hit",
+    )
+    if mapping is not None:
+        if mapping["SkipShow"]:
+            return None
+        return buildShow(mapping["title"], mapping["year"], mapping["ids"])
+
     # Parse the TV Show's name for year, if one is present in the string
     titleObj = getYearFromTitle(name)
 
     # Create a boolean to indicate if the title contains a year,
-    # this is used later on to improve the accuracy of picking
-    # from search results
+    # in which case it's used instead of the year the show first aired
     doesTitleIncludeYear = titleObj.yearValue != -1
 
     # If the title contains a year, then replace the local variable with the stripped version
@@ -153,132 +1179,255 @@ def getShowByName(name, seasonNo, episodeNo, tvShowYear):
         name = titleObj.titleWithoutYear
     year = titleObj.yearValue if doesTitleIncludeYear else tvShowYear
 
-    # Request the Trakt API for search results, using the name
-    tvSearch = TVShow.search(name)
+    # A show which was skipped by an older version of the script doesn't need searching for
+    legacyMatch = getUserMatchedShow(name)
+    if seriesId is not None and legacyMatch is not None and legacyMatch.get("SkipShow"):
+        saveShowMapping(seriesId, name, None, "user")
+        return None
+
+    # A show which was deferred by an earlier run is selected from the stored search results
+    deferredSelection = getDeferredSelection(seriesId) if seriesId is not None else None
+    if deferredSelection is not None:
+        showsWithSameName = [
+            buildShow(candidate["title"], candidate["year"], candidate["ids"])
+            for candidate in deferredSelection["Candidates"]
+        ]
+        if not interactive:
+            raise ManualSelectionRequired(
+                name, year, seasonNo, episodeNo, showsWithSameName, seriesId
+            )
+        return completeShowSelection(
+            name, year, seasonNo, episodeNo, showsWithSameName, seriesId
+        )
+
+    # If the show has been resolved before, then there's no need to search for it again
+    cachedShow = showCache.get(name, year)
+    metrics.increment(
+        "cache_lookups",
+        cache="show_cache",
+        result="miss" if cachedShow is None else "hit",
+    )
+    if cachedShow is not None:
+        if seriesId is not None:
+            saveShowMapping(seriesId, name, cachedShow, "auto")
+        return cachedShow
+
+    with metrics.timer("stage_seconds", stage="search"):
+        # Request the Trakt API for search results, using the name
+        tvSearch = TVShow.search(name)
+
+    # A selection made by an older version of the script is used ahead of the title matcher.
+    # It's an index into the search results as that version filtered them, so they're
+    # filtered the same way again to find the show which the user picked.
+    legacyMatch = getUserMatchedShow(name)
+    isLegacyMatchStale = False
+    if legacyMatch is not None:
+        legacyShows = filterLegacySearchResults(name, year, tvSearch)
+        try:
+            selectedIndex = int(legacyMatch.get("UserSelectedIndex"))
+        except (TypeError, ValueError):
+            selectedIndex = -1
+        # Only a selection which fits the results can be turned into a show mapping, since
+        # the mapping is kept for good
+        if legacyMatch.get("SkipShow") or 0 <= selectedIndex < len(legacyShows):
+            selectedShow = (
+                None if legacyMatch.get("SkipShow") else legacyShows[selectedIndex]
+            )
+            # Replace the index with the show's Trakt IDs, which don't depend on
+            # the order of the search results
+            if seriesId is not None:
+                saveShowMapping(seriesId, name, selectedShow, "user")
+            if selectedShow is not None:
+                showCache.put(name, year, selectedShow)
+            return selectedShow
+        isLegacyMatchStale = True
+        logging.warning(
+            f"The selection stored for '{name}' by an older version of the script doesn't match "
+            + "Trakt's search results anymore, so the show needs to be selected again."
+        )
+        forgetUserMatchedShow(name)
+
+    # When the stored selection couldn't be used, the user picks the show again rather than
+    # the title matcher
+    showsWithSameName = matchSearchResults(
+        name, year, tvSearch, seasonsCount, autoAccept=not isLegacyMatchStale
+    )
+
+    # When the user can't be asked right now, hand the selection back to the caller
+    if not interactive and len(showsWithSameName) > 1:
+        raise ManualSelectionRequired(
+            name, year, seasonNo, episodeNo, showsWithSameName, seriesId
+        )
+
+    return completeShowSelection(
+        name, year, seasonNo, episodeNo, showsWithSameName, seriesId
+    )
+
+
+# Raised by getShowByName when the show can't be determined automatically, and the user
+# can't be prompted from where it was called (e.g a worker thread).
+
+
+class ManualSelectionRequired(Exception):
+    def __init__(
+        self, name, year, seasonNo, episodeNo, showsWithSameName, seriesId=None
+    ):
+        super().__init__(f"Manual input is required to match the show '{name}'")
+        self.name = name
+        self.year = year
+        self.seasonNo = seasonNo
+        self.episodeNo = episodeNo
+        self.showsWithSameName = showsWithSameName
+        self.seriesId = seriesId
 
-    # Create an array of shows which have been matched
-    showsWithSameName = []
 
-    # Go through each result from the search
+def completeShowSelection(
+    name, year, seasonNo, episodeNo, showsWithSameName, seriesId=None
+):
+    with metrics.timer("stage_seconds", stage="select"):
+        traktShowObj = selectShow(
+            name, seasonNo, episodeNo, showsWithSameName, seriesId
+        )
+    # Only remember shows which were resolved, skipped shows are handled by
+    # the show mappings stored in the local database
+    if traktShowObj is not None:
+        showCache.put(name, year, traktShowObj)
+        # Store automatic matches too, so the show doesn't need to be searched for again
+        if seriesId is not None and getShowMapping(seriesId) is None:
+            saveShowMapping(seriesId, name, traktShowObj, "auto")
+
+    return traktShowObj
+
+
+def matchSearchResults(name, year, tvSearch, seasonsCount=None, autoAccept=True):
+    # Score the results, and if the best one is a clear winner then only use that one.
+    # Otherwise the results which could be the show are returned from best to worst.
+    ranked = titleMatcher.rank(
+        name, year, tvSearch, seasonsCount, getSeasonsCount=getTraktSeasonsCount
+    )
+    if autoAccept and titleMatcher.isConfident(ranked):
+        metrics.increment("title_matches", result="confident")
+        return [ranked[0][1]]
+
+    metrics.increment("title_matches", result="ambiguous" if ranked else "none")
+    return [show for _, show in ranked]
+
+
+# Filter the search results the way older versions of the script did, which the selections
+# they stored are an index into: the titles must share more than half of their words (by a
+# case sensitive substring check), and the year must be the same when it's known. A single
+# result with the same title and year, or with the same title, is used on its own.
+
+
+def filterLegacySearchResults(name, year, tvSearch):
+    showsWithSameName = []
     for show in tvSearch:
-        # Check if the title is a match, based on our conditions (e.g over 50% of words match)
         if checkTitleNameMatch(name, show.title):
-            # If the title included the year of broadcast, then we can be more picky in the results
-            # to look for a show with a broadcast year that matches
-            if doesTitleIncludeYear or (year and year > -1):
+            if year and year > -1:
                 # If the show title is a 1:1 match, with the same broadcast year, then bingo!
                 if (name == show.title) and (show.year == year):
-                    # Clear previous results, and only use this one
-                    showsWithSameName = []
-                    showsWithSameName.append(show)
+                    showsWithSameName = [show]
                     break
-
                 # Otherwise, only add the show if the broadcast year matches
                 if show.year == year:
                     showsWithSameName.append(show)
-            # If the program doesn't have the broadcast year, then add all the results
             else:
                 showsWithSameName.append(show)
 
-    # Sweep through the results once more for 1:1 title name matches,
-    # then if the list contains one entry with a 1:1 match, then clear the array
-    # and only use this one!
-    completeMatchNames = []
-    for nameFromSearch in showsWithSameName:
-        if nameFromSearch.title == name:
-            completeMatchNames.append(nameFromSearch)
-
+    completeMatchNames = [show for show in showsWithSameName if show.title == name]
     if len(completeMatchNames) == 1:
         showsWithSameName = completeMatchNames
 
+    return showsWithSameName
+
+
+def checkTitleNameMatch(tweeTitle, traktTitle):
+    # If the name is a complete match, then don't bother comparing them!
+    if tweeTitle == traktTitle:
+        return True
+
+    # Go through each word of the Twee title, and check if it's in the Trakt title
+    wordsMatched = [word for word in tweeTitle.split() if word in traktTitle]
+
+    # If more than 50% of words in the Twee title exist in the Trakt title,
+    # then return the title as a possibility to use
+    return len(wordsMatched) / len(traktTitle.split()) > 0.5
+
+
+# The number of seasons of a Trakt show, not counting the specials. The seasons are kept in
+# the season index, so they don't need to be requested again if the show is picked.
+
+
+def getTraktSeasonsCount(show):
+    try:
+        index = seasonIndex.get(show.slug)
+    except trakt.errors.NotFoundException:
+        return None
+    return len([seasonNo for seasonNo in index if seasonNo > 0])
+
+
+# Pick the show from the search results, prompting the user when there's more than one
+
+
+def selectShow(name, seasonNo, episodeNo, showsWithSameName, seriesId=None):
     # If the search contains multiple results, then we need to confirm with the user which show
-    # the script should use, or access the local database to see if the user has already provided
-    # a manual selection
+    # the script should use
     if len(showsWithSameName) > 1:
+        # Selections made by older versions of the script were already used by
+        # getShowByName, so prompt the user to make a selection
+        print(
+            f"INFO - MANUAL INPUT REQUIRED: The Twee data for Show '{name}' (Season {seasonNo}, Episode {episodeNo}) has {len(showsWithSameName)} matching Trakt shows with the same name."
+        )
 
-        # Query the local database for existing selection
-        userMatchedQuery = Query()
-        queryResult = userMatchedShowsTable.search(userMatchedQuery.ShowName == name)
-
-        # If the local database already contains an entry for a manual selection
-        # then don't bother prompting the user to select it again!
-        if len(queryResult) == 1:
-            # Get the first result from the query
-            firstMatch = queryResult[0]
-            # Get the value contains the selection index
-            firstMatchSelectedIndex = int(firstMatch.get("UserSelectedIndex"))
-            # Check if the user previously requested to skip the show
-            skipShow = firstMatch.get("SkipShow")
-            # If the user did not skip, but provided an index selection, get the
-            # matching show
-            if not skipShow:
-                return showsWithSameName[firstMatchSelectedIndex]
-            # Otherwise, return None, which will trigger the script to skip
-            # and move onto the next show
-            else:
-                return None
-        # If the user has not provided a manual selection already in the process
-        # then prompt the user to make a selection
-        else:
+        # Output each show for manual selection
+        for idx, item in enumerate(showsWithSameName):
+            # Display the show's title, broadcast year, amount of seasons and a link to the Trakt page.
+            # This will provide the user with enough information to make a selection.
             print(
-                f"INFO - MANUAL INPUT REQUIRED: The Twee data for Show '{name}' (Season {seasonNo}, Episode {episodeNo}) has {len(showsWithSameName)} matching Trakt shows with the same name."
+                f"    ({idx + 1}) {item.title} - {item.year} - {len(item.seasons)} Season(s) - More Info: https://trakt.tv/{item.ext}"
             )
 
-            # Output each show for manual selection
-            for idx, item in enumerate(showsWithSameName):
-                # Display the show's title, broadcast year, amount of seasons and a link to the Trakt page.
-                # This will provide the user with enough information to make a selection.
-                print(
-                    f"    ({idx + 1}) {item.title} - {item.year} - {len(item.seasons)} Season(s) - More Info: https://trakt.tv/{item.ext}"
+        while True:
+            try:
+                # Get the user's selection, either a numerical input, or a string 'SKIP' value
+                indexSelected = input(
+                    "Please make a selection from above (or enter SKIP):"
                 )
 
-            while True:
-                try:
-                    # Get the user's selection, either a numerical input, or a string 'SKIP' value
-                    indexSelected = input(
-                        "Please make a selection from above (or enter SKIP):"
-                    )
-
-                    if indexSelected != "SKIP":
-                        # Since the value isn't 'skip', check that the result is numerical
-                        indexSelected = int(indexSelected) - 1
-                        # Exit the selection loop
-                        break
-                    # Otherwise, exit the loop
-                    else:
-                        break
-                # Still allow the user to provide the exit input, and kill the program
-                except KeyboardInterrupt:
-                    sys.exit("Cancel requested...")
-                # Otherwise, the user has entered an invalid value, warn the user to try again
-                except Exception:
-                    logging.error(
-                        f"Sorry! Please select a value between 0 to {len(showsWithSameName)}"
-                    )
-
-            # If the user entered 'SKIP', then exit from the loop with no selection, which
-            # will trigger the program to move onto the next episode
-            if indexSelected == "SKIP":
-                # Record that the user has skipped the TV Show for import, so that
-                # manual input isn't required everytime
-                userMatchedShowsTable.insert(
-                    {"ShowName": name, "UserSelectedIndex": 0, "SkipShow": True}
+                if indexSelected != "SKIP":
+                    # Since the value isn't 'skip', check that the result is numerical
+                    indexSelected = int(indexSelected) - 1
+                    # Exit the selection loop
+                    break
+                # Otherwise, exit the loop
+                else:
+                    break
+            # Still allow the user to provide the exit input, and kill the program
+            except KeyboardInterrupt:
+                sys.exit("Cancel requested...")
+            # Otherwise, the user has entered an invalid value, warn the user to try again
+            except Exception:
+                logging.error(
+                    f"Sorry! Please select a value between 0 to {len(showsWithSameName)}"
                 )
 
-                return None
-            # Otherwise, return the selection which the user made from the list
-            else:
-                selectedShow = showsWithSameName[int(indexSelected)]
+        # If the user entered 'SKIP', then exit from the loop with no selection, which
+        # will trigger the program to move onto the next episode
+        if indexSelected == "SKIP":
+            # Record that the user has skipped the TV Show for import, so that
+            # manual input isn't required everytime
+            if seriesId is not None:
+                saveShowMapping(seriesId, name, None, "user")
 
-                userMatchedShowsTable.insert(
-                    {
-                        "ShowName": name,
-                        "UserSelectedIndex": indexSelected,
-                        "SkipShow": False,
-                    }
-                )
+            return None
+        # Otherwise, return the selection which the user made from the list
+        else:
+            selectedShow = showsWithSameName[int(indexSelected)]
+
+            if seriesId is not None:
+                saveShowMapping(seriesId, name, selectedShow, "user")
 
-                return selectedShow
+            return selectedShow
 
     else:
         if len(showsWithSameName) > 0:
@@ -289,191 +1438,1180 @@ def getShowByName(name, seasonNo, episodeNo, tvShowYear):
             return None
 
 
-def load_rows(backup_filename: str):
-    with open(backup_filename) as f:
-        data = json.load(f)
-    rows = []
+# Get every season of a show, including the episodes of each season, with a single request
+
+
+@trakt.core.get
+def getSeasonsWithEpisodes(slug):
+    data = yield f"shows/{slug}/seasons?extended=episodes"
+    yield data
+
+
+# Raised when an episode from Twee can't be found in the season index of the Trakt show.
+# The reason tells apart a season which doesn't exist in Trakt, a season which exists but
+# has no episodes listed, and an episode which is missing from its season.
+
+
+class EpisodeNotFound(Exception):
+    SEASON_MISSING = "season-missing"
+    SEASON_EMPTY = "season-empty"
+    EPISODE_MISSING = "episode-missing"
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+# PyTrakt requests a show's seasons, and then every episode of a season one at a time.
+# Instead, an index of each show's seasons and episodes is built with a single request,
+# and stored in the local database, keyed by the show's Trakt slug. Looking up an episode
+# is then just a couple of dictionary lookups.
+
+
+class SeasonIndex(object):
+    def __init__(self, storage, ttlHours):
+        self.storage = storage
+        self.ttlSeconds = ttlHours * 60 * 60
+        self.indexes = {}
+        # Locks which stop a show's seasons from being requested by more than one thread
+        self.slugLocks = {}
+
+    # Get the index of a show, which maps season numbers to episode numbers to Trakt
+    # episode IDs
+    def get(self, slug):
+        with self.slugLocks.setdefault(slug, threading.Lock()):
+            index = self.indexes.get(slug)
+            if index is not None:
+                metrics.increment("cache_lookups", cache="season_index", result="hit")
+                return index
+
+            # Only this show's index is read, rather than the whole table
+            document = self.storage.get("SeasonIndex", slug)
+            if (
+                document is None
+                or time.time() - document["fetchedAt"] > self.ttlSeconds
+            ):
+                metrics.increment("cache_lookups", cache="season_index", result="miss")
+                with metrics.timer("stage_seconds", stage="season_fetch"):
+                    document = self.fetch(slug)
+            else:
+                metrics.increment("cache_lookups", cache="season_index", result="hit")
+
+            # JSON only has string keys, so convert the numbers back once
+            index = {
+                int(seasonNo): {
+                    int(episodeNo): traktId for episodeNo, traktId in episodes.items()
+                }
+                for seasonNo, episodes in document["seasons"].items()
+            }
+            self.indexes[slug] = index
+            return index
+
+    def fetch(self, slug):
+        seasons = {}
+        for season in getSeasonsWithEpisodes(slug) or []:
+            seasons[str(season["number"])] = {
+                str(episode["number"]): episode["ids"]["trakt"]
+                for episode in season.get("episodes") or []
+            }
+        document = {"fetchedAt": time.time(), "seasons": seasons}
+        self.storage.put("SeasonIndex", slug, document)
+        self.storage.commit()
+        return document
+
+    @staticmethod
+    def findEpisode(index, seasonNo, episodeNo):
+        episodes = index.get(seasonNo)
+        if episodes is None:
+            raise EpisodeNotFound(EpisodeNotFound.SEASON_MISSING)
+        if not episodes:
+            raise EpisodeNotFound(EpisodeNotFound.SEASON_EMPTY)
+        traktEpisodeId = episodes.get(episodeNo)
+        if traktEpisodeId is None:
+            raise EpisodeNotFound(EpisodeNotFound.EPISODE_MISSING)
+        return traktEpisodeId
+
+
+seasonIndex = SeasonIndex(storage, config.SEASON_INDEX_TTL_HOURS)
+
+
+# Shows which couldn't be matched to a Trakt show, and episodes which couldn't be found in
+# Trakt, are remembered in the local database along with the reason and when it happened.
+# Until the entry expires, the show or episode is skipped before any request is made for it,
+# so a rerun only spends requests on the episodes which can succeed.
+
+
+class FailureCache(object):
+    # Reasons why a show failed, the reasons why an episode failed are those of EpisodeNotFound
+    SHOW_NOT_MATCHED = "show-not-matched"
+    SHOW_NOT_FOUND = "show-not-found"
+
+    def __init__(self, storage, ttlHours):
+        self.storage = storage
+        self.ttlSeconds = ttlHours * 60 * 60
+        self.shows = storage.all("FailedShows")
+        # The episodes are kept by their packed IDs, like the imported episodes
+        self.episodes = {
+            packEpisodeId(episodeId): document
+            for episodeId, document in storage.all("FailedEpisodes").items()
+        }
+
+    def isExpired(self, document):
+        return time.time() - document["failedAt"] > self.ttlSeconds
+
+    # Get the failure of a row's show, or of the episode itself, unless it has expired
+    def get(self, row):
+        for document in (
+            self.shows.get(row.show.seriesId),
+            self.episodes.get(row.key),
+        ):
+            if document is not None and not self.isExpired(document):
+                return document
+        return None
+
+    def addShow(self, row, reason):
+        self.add("FailedShows", self.shows, row.show.seriesId, row, reason)
+
+    def addEpisode(self, row, reason):
+        self.add("FailedEpisodes", self.episodes, row.key, row, reason)
+
+    def add(self, tableName, table, key, row, reason):
+        document = {
+            "SeriesId": row.show.seriesId,
+            "ShowName": getYearFromTitle(row.show.name).titleWithoutYear,
+            "reason": reason,
+            "failedAt": time.time(),
+        }
+        self.storage.put(tableName, self.getStorageKey(tableName, key), document)
+        self.storage.commit()
+        table[key] = document
+
+    @staticmethod
+    def getStorageKey(tableName, key):
+        return unpackEpisodeId(key) if tableName == "FailedEpisodes" else key
+
+    # Forget the failures of a Twee show, or every failure, so they're tried again
+    def forget(self, showName=None):
+        for tableName, table in (
+            ("FailedShows", self.shows),
+            ("FailedEpisodes", self.episodes),
+        ):
+            for key, document in list(table.items()):
+                if showName is None or document["ShowName"] == showName:
+                    self.storage.delete(tableName, self.getStorageKey(tableName, key))
+                    del table[key]
+        self.storage.commit()
+
+
+failureCache = FailureCache(storage, config.FAILURE_CACHE_TTL_HOURS)
+
+
+# Episodes which hit an error that's likely to go away (e.g Trakt's server being down)
+# are put in a retry queue, rather than retried straight away, so the import can carry on
+# with the other episodes in the meantime. Each retry waits twice as long as the one before.
+# The attempts are stored in the local database, so they carry on across restarts.
+
+
+class RetryQueue(object):
+    RATE_LIMITED = "rate-limited"
+    INVALID_RESPONSE = "invalid-response"
+    SERVER_ERROR = "server-error"
+
+    def __init__(self, storage, maxAttempts):
+        self.storage = storage
+        self.maxAttempts = maxAttempts
+        # The entries are kept by the packed IDs of their episodes
+        self.entries = {
+            packEpisodeId(episodeId): entry
+            for episodeId, entry in storage.all("RetryQueue").items()
+        }
+        # The rows waiting to be retried during this run, by their packed episode ID, and a
+        # heap of when each of them is due
+        self.rows = {}
+        self.dueTimes = []
+        # Episodes which ran out of attempts during this run
+        self.exhausted = []
+
+    # Whether a row is waiting for a retry, which was scheduled by a previous run
+    def isWaiting(self, row):
+        entry = self.entries.get(row.key)
+        return entry is not None and entry["retryAt"] > time.time()
+
+    # Schedule a row to be retried, returning False when it has run out of attempts
+    def add(self, rowsCount, row, reason):
+        episodeKey = row.key
+        attempts = self.entries.get(episodeKey, {"attempts": 0})["attempts"] + 1
+        metrics.increment("retries", reason=reason)
+        if attempts >= self.maxAttempts:
+            self.exhausted.append((row, reason))
+            self.remove(row)
+            return False
+
+        entry = {
+            "ShowName": row.show.name,
+            "Season": row.seasonNo,
+            "Episode": row.episodeNo,
+            "attempts": attempts,
+            "reason": reason,
+            "retryAt": time.time() + getBackoffSeconds(attempts),
+        }
+        self.storage.put("RetryQueue", row.episodeId, entry)
+        self.storage.commit()
+        self.entries[episodeKey] = entry
+        self.hold(rowsCount, row)
+        return True
+
+    # Keep a row in memory until it's due to be retried
+    def hold(self, rowsCount, row):
+        episodeKey = row.key
+        self.rows[episodeKey] = (rowsCount, row)
+        heapq.heappush(self.dueTimes, (self.entries[episodeKey]["retryAt"], episodeKey))
+
+    def remove(self, row):
+        if self.entries.pop(row.key, None) is not None:
+            self.storage.delete("RetryQueue", row.episodeId)
+            self.storage.commit()
+
+    # Get the rows which are due to be retried. When waiting, the rows are returned as
+    # they become due, until there are none left.
+    def popDue(self, wait=False):
+        while self.dueTimes:
+            retryAt, episodeKey = self.dueTimes[0]
+            # Skip over rows which were retried already, or have been rescheduled since
+            if (
+                episodeKey not in self.rows
+                or self.entries.get(episodeKey, {}).get("retryAt") != retryAt
+            ):
+                heapq.heappop(self.dueTimes)
+                continue
+
+            waitSeconds = retryAt - time.time()
+            if waitSeconds > 0:
+                if not wait:
+                    return
+                logging.info(
+                    f"Waiting {waitSeconds:.0f} seconds before retrying {len(self.rows)} episodes..."
+                )
+                metrics.increment("sleep_seconds", waitSeconds, reason="episode_retry")
+                time.sleep(waitSeconds)
+
+            heapq.heappop(self.dueTimes)
+            yield self.rows.pop(episodeKey)
+
+    def report(self):
+        if not self.exhausted:
+            return
+        logging.warning(
+            f"{len(self.exhausted)} episodes could not be imported after {self.maxAttempts} attempts, "
+            + "and will be tried again the next time the import is run:"
+        )
+        for row, reason in self.exhausted:
+            logging.warning(
+                f"    {row.show.name} Season {row.seasonNo}, Episode {row.episodeNo} ({reason})"
+            )
+
+
+retryQueue = RetryQueue(storage, RETRY_MAX_ATTEMPTS)
+
+
+# Get every show in the user's watched history, including the seasons and episodes which
+# have been watched, with a single request. PyTrakt's sync.get_watched requests the
+# watchlist instead, so it can't be used.
+
+
+@trakt.core.get
+def getWatchedShows():
+    data = yield "sync/watched/shows"
+    yield data
+
+
+# Episodes can already be in the user's Trakt history without being in the local database,
+# e.g if they were imported by another tool, or the local database was removed. Rather than
+# sending those episodes again, the user's history is downloaded once, and the episodes are
+# looked up by the Trakt ID of their show, and their season and episode numbers.
+
+
+def fetchWatchedEpisodes():
+    logging.info("Downloading the episodes which are already watched on Trakt...")
+    watchedEpisodes = set()
+    for watchedShow in getWatchedShows() or []:
+        showTraktId = watchedShow["show"]["ids"]["trakt"]
+        for season in watchedShow.get("seasons") or []:
+            for episode in season.get("episodes") or []:
+                watchedEpisodes.add((showTraktId, season["number"], episode["number"]))
+    logging.info(f"{len(watchedEpisodes)} episodes are already watched on Trakt.")
+    return watchedEpisodes
+
+
+def isEpisodeWatched(watchedEpisodes, traktShowId, row):
+    return (traktShowId, row.seasonNo, row.episodeNo) in watchedEpisodes
+
+
+# Check a row against the watched episodes without resolving its show, which is only
+# possible once the Twee show has been mapped to a Trakt show
+
+
+def isMappedEpisodeWatched(watchedEpisodes, row):
+    if not watchedEpisodes:
+        return False
+    mapping = getShowMapping(row.show.seriesId)
+    if mapping is None or mapping["SkipShow"]:
+        return False
+    return isEpisodeWatched(watchedEpisodes, mapping["ids"]["trakt"], row)
+
+
+# Add a batch of items to the user's watched history on Trakt, with a single request.
+# The response contains how many items were added, and the items which Trakt couldn't find.
+
+
+@trakt.core.post
+def addToHistory(payload):
+    result = yield "sync/history", payload
+    yield result
+
+
+# Marking each episode as seen individually costs one request per episode. Instead, the
+# import collects matched episodes - grouped by show and season - and submits them to
+# Trakt's history in large batches, each episode keeping its own watch time.
+
+
+class HistoryBatcher(object):
+    def __init__(self, batchSize, flushIntervalSeconds):
+        self.batchSize = batchSize
+        self.flushIntervalSeconds = flushIntervalSeconds
+        # Pending episodes, keyed by the Trakt show ID and season number
+        self.pending = {}
+        self.pendingCount = 0
+        self.lastFlushTime = time.time()
+        self.lock = threading.RLock()
+        # Batches are submitted one at a time, in a thread of their own, so that
+        # matching the following episodes can carry on in the meantime
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.futures = []
+        # Partial batches are also sent from a thread of their own, so that they aren't
+        # held up whilst the import waits (e.g for a show to be selected)
+        self.closed = threading.Event()
+        self.flushThread = threading.Thread(target=self.flushPeriodically, daemon=True)
+        self.flushThread.start()
+
+    def add(self, traktShowObj, seasonNo, traktEpisodeId, watchedAt, episodeKey):
+        with self.lock:
+            group = self.pending.setdefault((traktShowObj.trakt, seasonNo), [])
+            group.append(
+                {
+                    "episodeKey": episodeKey,
+                    "traktEpisodeId": traktEpisodeId,
+                    "watchedAt": watchedAt,
+                }
+            )
+            self.pendingCount += 1
+
+            # Send the batch once it's full
+            if self.pendingCount >= self.batchSize:
+                self.flush()
+
+    # Send the pending episodes once they have been waiting long enough
+    def flushPeriodically(self):
+        while not self.closed.wait(1):
+            with self.lock:
+                if time.time() - self.lastFlushTime >= self.flushIntervalSeconds:
+                    self.flush()
+
+    def flush(self):
+        with self.lock:
+            self.lastFlushTime = time.time()
+            if self.pendingCount == 0:
+                return
+
+            items = [item for group in self.pending.values() for item in group]
+            self.pending = {}
+            self.pendingCount = 0
+
+        payload = {"episodes": []}
+        for item in items:
+            episodePayload = {"ids": {"trakt": item["traktEpisodeId"]}}
+            # We pretend that we watched it when it aired because the default behavior on
+            # Trakt would be to set the watch time to when we run the import backfill.
+            # Twee unfortunately doesn't store when the show was actually watched.
+            if item["watchedAt"] is not None:
+                episodePayload["watched_at"] = timestamp(item["watchedAt"])
+            payload["episodes"].append(episodePayload)
+
+        with self.lock:
+            self.futures.append(self.executor.submit(self.submit, items, payload))
+
+    # Send any remaining episodes, and wait for every batch to be submitted
+    def close(self):
+        self.closed.set()
+        self.flushThread.join()
+        self.flush()
+        self.executor.shutdown(wait=True)
+
+        # The episodes of a batch which failed aren't marked as imported, so they will be
+        # sent again when the import is repeated
+        for future in self.futures:
+            try:
+                future.result()
+            except Exception:
+                logging.exception(
+                    "An unexpected error occurred whilst adding a batch of episodes to the history. "
+                    + "The episodes will be sent again the next time the import is run."
+                )
+        self.futures = []
+
+    def submit(self, items, payload):
+        # Total number of API errors in a row
+        errorStreak = 0
+        while True:
+            # Give up on the batch after too many errors. The episodes aren't marked as
+            # imported, so they will be sent again when the import is repeated.
+            if errorStreak > 10:
+                logging.warning(
+                    f"An error occurred 10 times in a row... skipping a batch of {len(items)} episodes..."
+                )
+                return
+            try:
+                with metrics.timer("stage_seconds", stage="history_submit"):
+                    response = addToHistory(payload)
+                break
+            except trakt.errors.RateLimitException:
+                logging.warning(
+                    "The program has repeatedly hit Trakt's API rate limit whilst adding a batch of episodes to the "
+                    + "history. The program will wait for as long as Trakt asks before trying again."
+                )
+                errorStreak += 1
+            except (
+                json.decoder.JSONDecodeError,
+                trakt.errors.TraktInternalException,
+                trakt.errors.TraktUnavailable,
+                requests.ConnectionError,
+                requests.Timeout,
+            ) as e:
+                errorStreak += 1
+                # The batch is sent in a thread of its own, so waiting doesn't hold up the import
+                waitSeconds = getBackoffSeconds(errorStreak)
+                logging.warning(
+                    f"An error occurred whilst adding a batch of episodes to the history ({type(e).__name__})! This "
+                    + "might occur when the server is down. The script will wait "
+                    + f"{waitSeconds:.0f} seconds before trying again."
+                )
+                metrics.increment("sleep_seconds", waitSeconds, reason="history_retry")
+                time.sleep(waitSeconds)
+
+        # Every episode which Trakt didn't report as missing has been added to the history
+        notFoundIds = {
+            notFound["ids"].get("trakt")
+            for notFound in (response or {}).get("not_found", {}).get("episodes", [])
+        }
+        syncedItems = [
+            item for item in items if item["traktEpisodeId"] not in notFoundIds
+        ]
+
+        # Add the episodes to the local database as imported, so they can be skipped,
+        # if the process is repeated
+        markEpisodesSynced([item["episodeKey"] for item in syncedItems])
+
+        logging.info(
+            f"Added a batch of {len(syncedItems)} episodes to the Trakt history."
+        )
+        if len(syncedItems) < len(items):
+            logging.warning(
+                f"Trakt could not find {len(items) - len(syncedItems)} episodes from the batch."
+            )
+
+
+# Each Twee show which has been completely imported is stored with a fingerprint of its
+# watched episodes. When a newer backup is imported, the shows with the same fingerprint
+# haven't had any episodes watched since, so they're skipped without building their rows,
+# and only the shows with newly watched episodes are processed.
+
+
+class ShowFingerprints(object):
+    def __init__(self, storage):
+        self.storage = storage
+        # The fingerprints are the keys, so a show which is in more than one profile of the
+        # backup can have a fingerprint for each of them
+        self.fingerprints = storage.all("ShowFingerprints")
+        self.unchangedFingerprints = set()
+        # The shows which were processed by this run, by their fingerprint
+        self.processedShows = {}
+
+    @staticmethod
+    def makeFingerprint(seriesId, episodeIds):
+        digest = hashlib.sha1(seriesId.encode())
+        for episodeId in sorted(episodeIds):
+            digest.update(b"\n" + episodeId.encode())
+        return digest.hexdigest()
+
+    # Check whether a show is unchanged since it was imported, otherwise remember its
+    # fingerprint, so it can be stored once all of its episodes have been imported
+    def isUnchanged(self, seriesId, episodeIds):
+        fingerprint = self.makeFingerprint(seriesId, episodeIds)
+        if fingerprint in self.fingerprints:
+            self.unchangedFingerprints.add(fingerprint)
+            return True
+        self.processedShows[fingerprint] = (
+            seriesId,
+            [packEpisodeId(episodeId) for episodeId in episodeIds],
+        )
+        return False
+
+    # Store the fingerprints of the processed shows whose episodes have all been imported.
+    # Shows with any episodes left (e.g which couldn't be found) are processed again next time.
+    def save(self):
+        items = [
+            (
+                fingerprint,
+                {
+                    "SeriesId": seriesId,
+                    "episodesCount": len(episodeKeys),
+                    "importedAt": time.time(),
+                },
+            )
+            for fingerprint, (seriesId, episodeKeys) in self.processedShows.items()
+            if all(isEpisodeSynced(episodeKey) for episodeKey in episodeKeys)
+        ]
+        self.storage.putMany("ShowFingerprints", items)
+        self.fingerprints.update(items)
+
+        # Drop the older fingerprints of the shows which have changed
+        processedSeriesIds = {seriesId for seriesId, _ in self.processedShows.values()}
+        for fingerprint, document in list(self.fingerprints.items()):
+            if (
+                document["SeriesId"] in processedSeriesIds
+                and fingerprint not in self.processedShows
+                and fingerprint not in self.unchangedFingerprints
+            ):
+                self.storage.delete("ShowFingerprints", fingerprint)
+                del self.fingerprints[fingerprint]
+        self.storage.commit()
+        self.processedShows = {}
+
+
+showFingerprints = ShowFingerprints(storage)
+
+
+# A large backup has hundreds of thousands of watched episodes, so each one is kept as a
+# compact record: the name, SeriesId and year are stored once by the TweeShow, which every
+# episode of the show refers to, the synthetic episode ID is packed into an integer, and
+# the time the episode aired is only parsed when the episode is sent to Trakt.
+
+
+class TweeShow(object):
+    __slots__ = ("name", "seriesId", "year", "seasonsCount")
+
+    def __init__(self, name, seriesId, year):
+        self.name = name
+        self.seriesId = seriesId
+        self.year = year
+        # The highest season which has been watched, to tell apart shows with the same title
+        self.seasonsCount = 0
+
+
+class WatchedEpisode(object):
+    __slots__ = ("show", "seasonNo", "episodeNo", "key", "aired")
+
+    def __init__(self, show, seasonNo, episodeNo, key, aired):
+        self.show = show
+        self.seasonNo = seasonNo
+        self.episodeNo = episodeNo
+        # The packed synthetic episode ID
+        self.key = key
+        self.aired = aired
+
+    # The synthetic episode ID, which the episode is stored under in the local database
+    @property
+    def episodeId(self):
+        return unpackEpisodeId(self.key)
+
+    def getAiredTime(self):
+        return None if self.aired is None else datetime.fromisoformat(self.aired)
+
+
+# Read the shows from a Twee backup. When streaming, the shows are parsed one at a time with
+# an incremental JSON parser (ijson), so that the whole backup never has to be held in memory.
+# Otherwise the backup is decoded in one go, using orjson if it's installed since it's faster.
+
+
+def iter_shows(backup_filename: str, stream: bool = False):
+    if stream and ijson is None:
+        logging.warning(
+            "Streaming the backup requires the 'ijson' package, so it will be read in one go instead."
+        )
+        stream = False
+
+    with open(backup_filename, "rb") as f:
+        if stream:
+            yield from ijson.items(f, "item.Shows.item")
+        else:
+            data = orjson.loads(f.read()) if orjson is not None else json.load(f)
+            for profile in data:
+                yield from profile["Shows"]
+
+
+def iter_rows(backup_filename: str, stream: bool = False, fingerprints=None):
     seen_ids = set()
-    for profile in data:
-        for show in profile["Shows"]:
-            for episode in show["Episodes"]:
-                # Skip unwatched episodes
-                if episode["Watched"] != "1":
-                    continue
-
-                # The episode IDs aren't unique for some reason, so we construct a synthetic one.
-                episode_id = (
-                    episode["Season"]
-                    + "-"
-                    + episode["Episode"]
-                    + "-"
-                    + show["SeriesId"]
-                    + "-"
-                    + episode["EpisodeId"]
+    # Shows which are in more than one profile share a single TweeShow
+    shows = {}
+    for show in iter_shows(backup_filename, stream):
+        # Skip unwatched episodes
+        episodes = [
+            episode for episode in show["Episodes"] if episode["Watched"] == "1"
+        ]
+        # The episode IDs aren't unique for some reason, so we construct a synthetic one.
+        episode_ids = [
+            episode["Season"]
+            + "-"
+            + episode["Episode"]
+            + "-"
+            + show["SeriesId"]
+            + "-"
+            + episode["EpisodeId"]
+            for episode in episodes
+        ]
+        # Skip the show if no episodes have been watched since it was imported
+        if fingerprints is not None and fingerprints.isUnchanged(
+            show["SeriesId"], episode_ids
+        ):
+            continue
+
+        show_key = (show["SeriesId"], show["Name"], show["FirstAired"])
+        twee_show = shows.get(show_key)
+        if twee_show is None:
+            twee_show = TweeShow(
+                show["Name"],
+                show["SeriesId"],
+                int(show["FirstAired"].split("-")[0]) if show["FirstAired"] else -1,
+            )
+            shows[show_key] = twee_show
+        for episode in episodes:
+            twee_show.seasonsCount = max(twee_show.seasonsCount, int(episode["Season"]))
+
+        for episode, episode_id in zip(episodes, episode_ids):
+            packed_id = packEpisodeId(episode_id)
+            if packed_id in seen_ids:
+                raise ValueError(
+                    f'The episode ID "{episode_id}" exists for more than one episode.'
+                )
+
+            seen_ids.add(packed_id)
+            yield WatchedEpisode(
+                twee_show,
+                int(episode["Season"]),
+                int(episode["Episode"]),
+                packed_id,
+                episode["Aired"] or None,
+            )
+
+
+def load_rows(backup_filename: str, fingerprints=None):
+    return list(iter_rows(backup_filename, fingerprints=fingerprints))
+
+
+# The import is split into stages which run concurrently: shows are resolved, and their
+# seasons are fetched, by pools of worker threads ahead of the row being processed, whilst
+# matched episodes are submitted to the history by the HistoryBatcher. Every row is still
+# processed (and logged) in order by the main thread, so the output and the local database
+# don't depend on the timing of the workers. All of the threads share the rate limiter, so
+# the import runs as fast as Trakt's API allows.
+
+
+class ImportPipeline(object):
+    def __init__(self, workerThreads, deferPrompts=False):
+        self.showExecutor = concurrent.futures.ThreadPoolExecutor(workerThreads)
+        self.seasonExecutor = concurrent.futures.ThreadPoolExecutor(workerThreads)
+        # Futures for the show and season index of each Twee show, so that each one is
+        # only requested once
+        self.showFutures = {}
+        self.seasonIndexFutures = {}
+        # Shows which need the user to pick from the search results. The user can only be
+        # prompted from the main thread, so the selections wait here until then.
+        self.manualSelections = queue.Queue()
+        # When prompts are deferred, the selections are stored in the local database instead,
+        # and the shows are skipped for this run
+        self.deferPrompts = deferPrompts
+        self.deferredShowKeys = set()
+
+    @staticmethod
+    def getShowKey(row):
+        return row.show.seriesId
+
+    def getShowFuture(self, row):
+        showKey = self.getShowKey(row)
+        future = self.showFutures.get(showKey)
+        if future is None:
+            future = concurrent.futures.Future()
+            self.showFutures[showKey] = future
+            self.showExecutor.submit(self.resolveShow, future, row)
+        return future
+
+    def resolveShow(self, future, row):
+        try:
+            future.set_result(
+                getShowByName(
+                    row.show.name,
+                    row.seasonNo,
+                    row.episodeNo,
+                    row.show.year,
+                    seriesId=row.show.seriesId,
+                    interactive=False,
+                    seasonsCount=row.show.seasonsCount,
                 )
-                if episode_id in seen_ids:
-                    raise ValueError(
-                        f'The episode ID "{episode_id}" exists for more than one episode.'
+            )
+        except ManualSelectionRequired as selection:
+            self.manualSelections.put((future, selection, self.getShowKey(row)))
+        except Exception as e:
+            future.set_exception(e)
+
+    def getSeasonIndexFuture(self, row):
+        showKey = self.getShowKey(row)
+        future = self.seasonIndexFutures.get(showKey)
+        if future is None:
+            future = self.seasonExecutor.submit(
+                self.fetchSeasonIndex, self.getShowFuture(row)
+            )
+            self.seasonIndexFutures[showKey] = future
+        return future
+
+    def fetchSeasonIndex(self, showFuture):
+        traktShowObj = showFuture.result()
+        if traktShowObj is None:
+            return None
+        return seasonIndex.get(traktShowObj.slug)
+
+    # Start resolving the show and fetching the seasons of a row, before it's processed
+    def prefetch(self, row):
+        self.getSeasonIndexFuture(row)
+
+    # Forget the show and seasons of a row, so they're requested again (e.g after an error)
+    def forget(self, row):
+        showKey = self.getShowKey(row)
+        self.showFutures.pop(showKey, None)
+        self.seasonIndexFutures.pop(showKey, None)
+
+    # Wait for the result of one of the stages, prompting the user to make any manual
+    # selections which are required in the meantime
+    def waitFor(self, future):
+        while True:
+            try:
+                return future.result(timeout=0.1)
+            except concurrent.futures.TimeoutError:
+                if self.deferPrompts:
+                    self.deferManualSelections()
+                else:
+                    self.answerManualSelections()
+
+    def answerManualSelections(self):
+        while True:
+            try:
+                future, selection, showKey = self.manualSelections.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                future.set_result(
+                    completeShowSelection(
+                        selection.name,
+                        selection.year,
+                        selection.seasonNo,
+                        selection.episodeNo,
+                        selection.showsWithSameName,
+                        selection.seriesId,
                     )
+                )
+            except Exception as e:
+                future.set_exception(e)
 
-                seen_ids.add(episode_id)
-                rows.append(
-                    {
-                        "tv_show_name": show["Name"],
-                        "tv_show_year": int(show["FirstAired"].split("-")[0])
-                        if show["FirstAired"]
-                        else -1,
-                        "episode_id": episode_id,
-                        "episode_season_number": int(episode["Season"]),
-                        "episode_number": int(episode["Episode"]),
-                        "episode_aired": datetime.fromisoformat(episode["Aired"])
-                        if episode["Aired"]
-                        else None,
-                    }
+    def deferManualSelections(self):
+        while True:
+            try:
+                future, selection, showKey = self.manualSelections.get_nowait()
+            except queue.Empty:
+                return
+            if getDeferredSelection(showKey) is None:
+                saveDeferredSelection(
+                    showKey,
+                    selection.name,
+                    selection.year,
+                    selection.showsWithSameName,
                 )
+            self.deferredShowKeys.add(showKey)
+            future.set_result(None)
+
+    def close(self):
+        # Cancel the shows which are still waiting for a selection, so that the
+        # workers waiting on them can finish
+        while True:
+            try:
+                future, _, _ = self.manualSelections.get_nowait()
+            except queue.Empty:
+                break
+            future.cancel()
+        self.showExecutor.shutdown(wait=False, cancel_futures=True)
+        self.seasonExecutor.shutdown(wait=False, cancel_futures=True)
 
-    return rows
 
+# Walk through the rows, starting to fetch the show and season of the upcoming rows that
+# haven't been imported (or watched on Trakt) yet, so they're ready by the time they're processed
 
-def processWatchedShows(backup_filename: str, dry_run: bool):
-    # Total number of API errors in a row
-    errorStreak = 0
-    # Loop through each episode
-    rows = load_rows(backup_filename)
-    rowsTotal = len(rows)
+
+def prefetchRows(rows, pipeline, lookahead, watchedEpisodes=frozenset()):
+    pendingRows = collections.deque()
     for rowsCount, row in enumerate(rows):
-        # Get the name of the TV show
-        tvShowName = row["tv_show_name"]
-        # Get the year the TV show aired
-        tvShowYear = row["tv_show_year"]
-        # Get the Twee Episode Id
-        tvShowEpisodeId = row["episode_id"]
-        # Get the Twee Season Number
-        tvShowSeasonNo = row["episode_season_number"]
-        # Get the Twee Episode Number
-        tvShowEpisodeNo = row["episode_number"]
-        # Get the timestamp that the episode aired
-        tvShowEpisodeAired = row["episode_aired"]
-
-        # Query the local database for previous entries indicating that
-        # the episode has already been imported in the past. Which will
-        # ease pressure on Twee's API server during a retry of the import
-        # process, and just save time overall without needing to create network requests
-        episodeCompletedQuery = Query()
-        queryResult = syncedEpisodesTable.search(
-            episodeCompletedQuery.episodeId == tvShowEpisodeId
+        if not isEpisodeSynced(row.key) and failureCache.get(row) is None:
+            if not watchedEpisodes:
+                pipeline.prefetch(row)
+            # Until its show has been resolved, it isn't known whether the episode is already
+            # watched, so the seasons aren't fetched yet in case they aren't needed at all
+            elif getShowMapping(row.show.seriesId) is None:
+                pipeline.getShowFuture(row)
+            elif not isMappedEpisodeWatched(watchedEpisodes, row):
+                pipeline.prefetch(row)
+        pendingRows.append((rowsCount, row))
+        if len(pendingRows) > lookahead:
+            yield pendingRows.popleft()
+    yield from pendingRows
+
+
+# Retry the rows which hit an error as soon as they're due, in between the other rows. Once
+# every other row has been processed, wait for the rows which are still due to be retried.
+
+
+def withRetries(rows, historyBatcher):
+    for rowsCount, row in rows:
+        yield from retryQueue.popDue()
+        yield rowsCount, row
+
+    # Send the episodes which have been matched so far, rather than holding on to them
+    # whilst waiting
+    historyBatcher.flush()
+    yield from retryQueue.popDue(wait=True)
+
+
+# The first phase of a two-phase import: every distinct show which has episodes left to
+# import is resolved before any episodes are synced. All of the shows are searched for
+# concurrently, and any manual selections are either asked for straight away, or deferred
+# until a later run. The episodes can then be synced without stopping for the user.
+
+
+def resolveShows(rows, pipeline):
+    showRows = {}
+    for row in rows:
+        if not isEpisodeSynced(row.key) and failureCache.get(row) is None:
+            showRows.setdefault(pipeline.getShowKey(row), row)
+
+    logging.info(f"Resolving {len(showRows)} shows before importing any episodes...")
+    futures = [pipeline.getShowFuture(row) for row in showRows.values()]
+    for future in futures:
+        # Errors are left for the import itself to retry
+        try:
+            pipeline.waitFor(future)
+        except Exception:
+            pass
+
+    if pipeline.deferPrompts and pipeline.deferredShowKeys:
+        logging.warning(
+            f"{len(pipeline.deferredShowKeys)} shows need a manual selection, and will be skipped. "
+            + "Run the import again without --defer-prompts to choose them."
         )
 
-        # If the query returned no results, then continue to import it into Trakt
-        if len(queryResult) == 0:
-            # Create a repeating loop, which will break on success, but repeats on failures
-            while True:
-                # If more than 10 errors occurred in one streak, whilst trying to import the episode
-                # then give up, and move onto the next episode, but warn the user.
-                if errorStreak > 10:
-                    logging.warning(
-                        "An error occurred 10 times in a row... skipping episode..."
-                    )
-                    break
+
+# Log how far through the import is at regular intervals, with the current rate and how long
+# the rest of the import is expected to take. The metrics file is updated at the same time.
+
+
+class ImportProgress(object):
+    def __init__(self, rowsTotal, intervalSeconds, metricsPath=None):
+        self.rowsTotal = rowsTotal
+        self.intervalSeconds = intervalSeconds
+        self.metricsPath = metricsPath
+        self.rowsDone = 0
+        self.startTime = time.monotonic()
+        self.lastReportTime = self.startTime
+
+    def update(self, rowsCount):
+        # Rows which are retried come round again, so they don't count twice
+        self.rowsDone = max(self.rowsDone, rowsCount + 1)
+        now = time.monotonic()
+        if now - self.lastReportTime >= self.intervalSeconds:
+            self.lastReportTime = now
+            self.report(now)
+
+    def report(self, now):
+        rowsPerSecond = self.rowsDone / max(now - self.startTime, 0.001)
+        message = f"Progress: {self.rowsDone}/{self.rowsTotal} rows, {rowsPerSecond:.1f} rows/sec"
+        # The total isn't known when the backup is streamed
+        if isinstance(self.rowsTotal, int) and rowsPerSecond > 0:
+            remaining = timedelta(
+                seconds=round((self.rowsTotal - self.rowsDone) / rowsPerSecond)
+            )
+            message += f", about {remaining} remaining"
+        logging.info(message + ".")
+        self.save()
+
+    def save(self):
+        if self.metricsPath:
+            metrics.save(self.metricsPath)
+
+
+def processWatchedShows(
+    backup_filename: str,
+    dry_run: bool,
+    stream: bool = False,
+    resolve_first: bool = False,
+    defer_prompts: bool = False,
+    skip_watched: bool = False,
+    metrics_file: str = None,
+):
+    # Episodes which are already watched on Trakt are skipped, if requested
+    watchedEpisodes = fetchWatchedEpisodes() if skip_watched else frozenset()
+    # Twee IDs of the skipped episodes, which are added to the local database in batches
+    watchedEpisodeIds = []
+    # Loop through each episode. When streaming, the import starts on the first show
+    # whilst the rest of the backup is still being read, so the total isn't known.
+    # Shows which haven't changed since they were imported are left out.
+    if stream:
+        rows = iter_rows(backup_filename, stream=True, fingerprints=showFingerprints)
+        rowsTotal = "?"
+    else:
+        rows = load_rows(backup_filename, fingerprints=showFingerprints)
+        rowsTotal = len(rows)
+    # Matched episodes are collected, and sent to Trakt in batches
+    historyBatcher = HistoryBatcher(
+        config.SYNC_BATCH_SIZE, config.SYNC_FLUSH_INTERVAL_SECONDS
+    )
+    # Shows and seasons are fetched concurrently, ahead of the rows which need them
+    pipeline = ImportPipeline(config.WORKER_THREADS, deferPrompts=defer_prompts)
+    # Shows which were searched for again after their Trakt show couldn't be found
+    researchedShowKeys = set()
+    progress = None
+    try:
+        # Resolve every show first, if requested. This needs all of the rows up front.
+        if resolve_first:
+            rows = list(rows)
+            rowsTotal = len(rows)
+            resolveShows(rows, pipeline)
+
+        progress = ImportProgress(rowsTotal, PROGRESS_INTERVAL_SECONDS, metrics_file)
+        for rowsCount, row in withRetries(
+            prefetchRows(rows, pipeline, PIPELINE_LOOKAHEAD_ROWS, watchedEpisodes),
+            historyBatcher,
+        ):
+            progress.update(rowsCount)
+            # Get the name of the TV show
+            tvShowName = row.show.name
+            # Get the packed Twee Episode Id
+            tvShowEpisodeId = row.key
+            # Get the Twee Season Number
+            tvShowSeasonNo = row.seasonNo
+            # Get the Twee Episode Number
+            tvShowEpisodeNo = row.episodeNo
+
+            # Skip the episode if it, or its show, couldn't be found by a previous run
+            failure = (
+                failureCache.get(row) if not isEpisodeSynced(tvShowEpisodeId) else None
+            )
+            if failure is not None:
+                metrics.increment("rows", result="previously_failed")
+                logging.info(
+                    f"({rowsCount}/{rowsTotal}) - Skipping '{tvShowName}' Season {tvShowSeasonNo} / Episode {tvShowEpisodeNo}, "
+                    + f"which failed in a previous run ({failure['reason']}). Use --retry-failed to try it again."
+                )
+            # Episodes which failed in a previous run, and aren't due to be retried yet,
+            # wait in the retry queue whilst the import carries on
+            elif not isEpisodeSynced(tvShowEpisodeId) and retryQueue.isWaiting(row):
+                metrics.increment("rows", result="waiting_to_retry")
+                logging.info(
+                    f"({rowsCount}/{rowsTotal}) - '{tvShowName}' Season {tvShowSeasonNo} / Episode {tvShowEpisodeNo} "
+                    + "is waiting to be retried."
+                )
+                retryQueue.hold(rowsCount, row)
+            # Query the local database for previous entries indicating that
+            # the episode has already been imported in the past. Which will
+            # ease pressure on Twee's API server during a retry of the import
+            # process, and just save time overall without needing to create network requests
+            # If the episode hasn't been imported, then continue to import it into Trakt
+            elif not isEpisodeSynced(tvShowEpisodeId):
+                # Whether the episode has been put in the retry queue after an error
+                isRetrying = False
                 try:
-                    # Sleep for a second between each process, before going onto the next watched episode.
-                    # This is required to remain within the API rate limit, and use the API server fairly.
-                    # Other developers share the service, for free - so be considerate of your usage.
-                    time.sleep(DELAY_BETWEEN_EPISODES_IN_SECONDS)
-                    # Search Trakt for the TV show matching Twee's title value
-                    traktShowObj = getShowByName(
-                        tvShowName, tvShowSeasonNo, tvShowEpisodeNo, tvShowYear
-                    )
+                    # There's no need to wait between episodes, each request to Trakt is paced
+                    # by the rate limiter to remain within the API rate limit, and use the API
+                    # server fairly. Other developers share the service, for free.
+                    traktShowObj = None
+                    # Wait for the TV show matching Twee's title value to be found
+                    with metrics.timer("stage_seconds", stage="wait_show"):
+                        traktShowObj = pipeline.waitFor(pipeline.getShowFuture(row))
                     # If the method returned 'None', then this is an indication to skip the episode, and
                     # move onto the next one
                     if traktShowObj is None:
-                        logging.warning(f"No match was found for '{tvShowName}'!")
-                        break
+                        metrics.increment("rows", result="skipped")
+                        if pipeline.getShowKey(row) in pipeline.deferredShowKeys:
+                            logging.warning(
+                                f"({rowsCount}/{rowsTotal}) - Skipping '{tvShowName}', which is waiting for a manual selection."
+                            )
+                        else:
+                            logging.warning(f"No match was found for '{tvShowName}'!")
+                            # Shows which the user chose to skip are already remembered
+                            # by their mappings
+                            if getShowMapping(row.show.seriesId) is None:
+                                failureCache.addShow(row, FailureCache.SHOW_NOT_MATCHED)
+                        continue
+                    # If the episode is already watched on Trakt, then there's no need to send it again
+                    if isEpisodeWatched(watchedEpisodes, traktShowObj.trakt, row):
+                        metrics.increment("rows", result="already_watched")
+                        logging.info(
+                            f"({rowsCount+1}/{rowsTotal}) - Already watched on Trakt, skipping '{tvShowName}' Season {tvShowSeasonNo} / Episode {tvShowEpisodeNo}."
+                        )
+                        if not dry_run:
+                            watchedEpisodeIds.append(tvShowEpisodeId)
+                            if len(watchedEpisodeIds) >= config.SYNC_BATCH_SIZE:
+                                markEpisodesSynced(watchedEpisodeIds)
+                                watchedEpisodeIds = []
+                        continue
                     # Show the progress of the import on-screen
                     logging.info(
                         f"({rowsCount+1}/{rowsTotal}) - Processing '{tvShowName}' Season {tvShowSeasonNo} / Episode {tvShowEpisodeNo}"
                         f" matched as {traktShowObj.title} ({traktShowObj.year})."
                     )
-                    # Get the season from the Trakt API
-                    season = next(
-                        season
-                        for season in traktShowObj.seasons
-                        if season.number == tvShowSeasonNo
-                    )
+                    # Wait for the seasons and episodes of the show to be fetched from the Trakt API
+                    with metrics.timer("stage_seconds", stage="wait_seasons"):
+                        showSeasonIndex = pipeline.waitFor(
+                            pipeline.getSeasonIndexFuture(row)
+                        )
                     # Get the episode from the season
-                    episode = next(
-                        episode
-                        for episode in season.episodes
-                        if episode.number == tvShowEpisodeNo
+                    traktEpisodeId = SeasonIndex.findEpisode(
+                        showSeasonIndex, tvShowSeasonNo, tvShowEpisodeNo
                     )
+                    metrics.increment("rows", result="matched")
 
                     # If this is a dry-run, then bail before updating anything in Trakt.
                     if dry_run:
-                        break
-
-                    # Mark the episode as watched!
-                    # We pretend that we watched it when it aired because the default behavior on
-                    # Trakt would be to set the watch time to when we run the import backfill.
-                    # Twee unfortunately doesn't store when the show was actually watched.
-                    episode.mark_as_seen(watched_at=tvShowEpisodeAired)
-                    # Add the episode to the local database as imported, so it can be skipped,
-                    # if the process is repeated
-                    syncedEpisodesTable.insert({"episodeId": tvShowEpisodeId})
-                    # Clear the error streak on completing the method without errors
-                    errorStreak = 0
-                    break
-                # Catch errors which occur because of an incorrect array index. This occurs when
-                # an incorrect Trakt show has been selected, with season/episodes which don't match Twee.
-                # It can also occur due to a bug in Trakt Py, whereby some seasons contain an empty array of episodes.
-                except (IndexError, StopIteration):
-                    tvShowSlug = traktShowObj.to_json()["shows"][0]["ids"]["ids"][
-                        "slug"
-                    ]
-                    logging.warning(
-                        f"({rowsCount}/{rowsTotal}) - {tvShowName} Season {tvShowSeasonNo}, Episode {tvShowEpisodeNo} does not exist in Trakt! (https://trakt.tv/shows/{tvShowSlug}/seasons/{tvShowSeasonNo}/episodes/{tvShowEpisodeNo})"
+                        continue
+
+                    # Queue the episode to be marked as watched! It's sent along with
+                    # the rest of its batch, using the time that the episode aired.
+                    historyBatcher.add(
+                        traktShowObj,
+                        tvShowSeasonNo,
+                        traktEpisodeId,
+                        row.getAiredTime(),
+                        tvShowEpisodeId,
                     )
-                    break
+                # Catch errors which occur because the episode isn't in the season index. This occurs when
+                # an incorrect Trakt show has been selected, with season/episodes which don't match Twee.
+                except EpisodeNotFound as e:
+                    metrics.increment("rows", result="not_found")
+                    tvShowSlug = traktShowObj.slug
+                    failureCache.addEpisode(row, e.reason)
+                    if e.reason == EpisodeNotFound.SEASON_MISSING:
+                        logging.warning(
+                            f"({rowsCount}/{rowsTotal}) - {tvShowName} Season {tvShowSeasonNo} does not exist in Trakt! (https://trakt.tv/shows/{tvShowSlug}/seasons)"
+                        )
+                    # Unlike the season endpoints used by Trakt Py, which could return an empty array of
+                    # episodes because of a bug, the season index always lists the episodes Trakt knows about
+                    elif e.reason == EpisodeNotFound.SEASON_EMPTY:
+                        logging.warning(
+                            f"({rowsCount}/{rowsTotal}) - {tvShowName} Season {tvShowSeasonNo} has no episodes listed in Trakt! (https://trakt.tv/shows/{tvShowSlug}/seasons/{tvShowSeasonNo})"
+                        )
+                    else:
+                        logging.warning(
+                            f"({rowsCount}/{rowsTotal}) - {tvShowName} Season {tvShowSeasonNo}, Episode {tvShowEpisodeNo} does not exist in Trakt! (https://trakt.tv/shows/{tvShowSlug}/seasons/{tvShowSeasonNo}/episodes/{tvShowEpisodeNo})"
+                        )
                 # Catch any errors which are raised because a show could not be found in Trakt
                 except trakt.errors.NotFoundException:
+                    metrics.increment("rows", result="not_found")
+                    # The cached show might no longer exist under the same slug, so it's
+                    # searched for again by the show's following episodes. Only when that
+                    # doesn't help either is the show skipped until the failure expires.
+                    showKey = pipeline.getShowKey(row)
+                    if traktShowObj is not None and showKey not in researchedShowKeys:
+                        researchedShowKeys.add(showKey)
+                        showCache.invalidate(slug=traktShowObj.slug)
+                        forgetShowMappings(slug=traktShowObj.slug)
+                        pipeline.forget(row)
+                    else:
+                        failureCache.addShow(row, FailureCache.SHOW_NOT_FOUND)
                     logging.warning(
                         f"({rowsCount}/{rowsTotal}) - {tvShowName} Season {tvShowSeasonNo}, Episode {tvShowEpisodeNo} does not exist (search) in Trakt!"
                     )
-                    break
                 # Catch errors because of the program breaching the Trakt API rate limit
                 except trakt.errors.RateLimitException:
                     logging.warning(
-                        "The program is running too quickly and has hit Trakt's API rate limit! Please increase the delay between "
-                        + "episdoes via the variable 'DELAY_BETWEEN_EPISODES_IN_SECONDS'. The program will now wait 60 seconds before "
-                        + "trying again."
+                        f"({rowsCount}/{rowsTotal}) - The program has repeatedly hit Trakt's API rate limit whilst processing "
+                        + f"{tvShowName} Season {tvShowSeasonNo}, Episode {tvShowEpisodeNo}! The episode will be tried again later."
                     )
-                    time.sleep(60)
-
-                    # Mark the exception in the error streak
-                    errorStreak += 1
+                    metrics.increment("rows", result="retrying")
+                    # Request the show and season again when retrying
+                    pipeline.forget(row)
+                    isRetrying = retryQueue.add(rowsCount, row, RetryQueue.RATE_LIMITED)
                 # Catch a JSON decode error - this can be raised when the API server is down and produces a HTML page, instead of JSON
                 except json.decoder.JSONDecodeError:
                     logging.warning(
                         f"({rowsCount}/{rowsTotal}) - A JSON decode error occuring whilst processing {tvShowName} "
                         + f"Season {tvShowSeasonNo}, Episode {tvShowEpisodeNo}! This might occur when the server is down and has produced "
-                        + "a HTML document instead of JSON. The script will wait 60 seconds before trying again."
+                        + "a HTML document instead of JSON. The episode will be tried again later."
                     )
+                    metrics.increment("rows", result="retrying")
+                    # Request the show and season again when retrying
+                    pipeline.forget(row)
+                    isRetrying = retryQueue.add(
+                        rowsCount, row, RetryQueue.INVALID_RESPONSE
+                    )
+                # Catch errors which are still there after the request was retried, e.g when Trakt's
+                # server is down or doesn't respond in time
+                except (
+                    trakt.errors.TraktInternalException,
+                    trakt.errors.TraktUnavailable,
+                    requests.ConnectionError,
+                    requests.Timeout,
+                ) as e:
+                    logging.warning(
+                        f"({rowsCount}/{rowsTotal}) - An error occurred whilst processing {tvShowName} "
+                        + f"Season {tvShowSeasonNo}, Episode {tvShowEpisodeNo} ({type(e).__name__})! This might occur "
+                        + "when the server is down. The episode will be tried again later."
+                    )
+                    metrics.increment("rows", result="retrying")
+                    # Request the show and season again when retrying
+                    pipeline.forget(row)
+                    isRetrying = retryQueue.add(rowsCount, row, RetryQueue.SERVER_ERROR)
+                finally:
+                    # Unless it's waiting to be retried, the episode is finished with
+                    if not isRetrying:
+                        retryQueue.remove(row)
+            # Skip the episode
+            else:
+                metrics.increment("rows", result="already_imported")
+                logging.info(
+                    f"({rowsCount}/{rowsTotal}) - Already imported, skipping '{tvShowName}' Season {tvShowSeasonNo} / Episode {tvShowEpisodeNo}."
+                )
 
-                    # Wait 60 seconds
-                    time.sleep(60)
-
-                    # Mark the exception in the error streak
-                    errorStreak += 1
-                # Catch a CTRL + C keyboard input, and exits the program
-                except KeyboardInterrupt:
-                    sys.exit("Cancel requested...")
-        # Skip the episode
-        else:
+        # Report the episodes which couldn't be imported, however many times they were tried
+        retryQueue.report()
+        if showFingerprints.unchangedFingerprints:
             logging.info(
-                f"({rowsCount}/{rowsTotal}) - Already imported, skipping '{tvShowName}' Season {tvShowSeasonNo} / Episode {tvShowEpisodeNo}."
+                f"Skipped {len(showFingerprints.unchangedFingerprints)} shows without any newly watched episodes "
+                + "since they were imported."
             )
-
-
-def start(backup_filename: str):
+    # Catch a CTRL + C keyboard input, and exits the program
+    except KeyboardInterrupt:
+        sys.exit("Cancel requested...")
+    finally:
+        pipeline.close()
+        # Send the episodes which have already been matched, including the remaining
+        # episodes which haven't filled a complete batch
+        historyBatcher.close()
+        # Remember the episodes which were already watched on Trakt, so they're skipped
+        # without downloading the history again next time
+        markEpisodesSynced(watchedEpisodeIds)
+        # Remember which shows are now completely imported, so the next import can skip them
+        showFingerprints.save()
+        # Show where the time went, and save the final metrics
+        metrics.logSummary()
+        if progress is not None:
+            progress.save()
+
+
+def start(backup_filename: str, **importOptions):
     # Create the initial authentication with Trakt, before starting the process.
     if initTraktAuth():
         # Display a menu selection
@@ -492,11 +2630,11 @@ def start(backup_filename: str):
         if menuSelection == 1:
             # Invoke the method which will import episodes which have been watched
             # from Twee into Trakt.
-            processWatchedShows(backup_filename, dry_run=False)
+            processWatchedShows(backup_filename, dry_run=False, **importOptions)
         elif menuSelection == 2:
             # Invoke the method which will import episodes which have been watched
             # from Twee into Trakt.
-            processWatchedShows(backup_filename, dry_run=True)
+            processWatchedShows(backup_filename, dry_run=True, **importOptions)
         else:
             logging.warning("Sorry - that's an unknown menu selection")
     else:
@@ -506,14 +2644,96 @@ def start(backup_filename: str):
 
 
 if __name__ == "__main__":
-    backup_filename = sys.argv[1] if len(sys.argv) > 1 else "twee.json"
+    parser = argparse.ArgumentParser(
+        description="Import watched episodes from a Twee backup into Trakt."
+    )
+    parser.add_argument(
+        "backup_filename",
+        nargs="?",
+        default="twee.json",
+        help="the Twee backup file to import (default: twee.json)",
+    )
+    parser.add_argument(
+        "--clear-show-cache",
+        action="store_true",
+        help="forget every cached Twee to Trakt show match before starting",
+    )
+    parser.add_argument(
+        "--forget-show",
+        action="append",
+        default=[],
+        metavar="NAME",
+        help="forget the cached Trakt match for a Twee show (can be repeated)",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="read the backup incrementally whilst importing (requires ijson)",
+    )
+    parser.add_argument(
+        "--resolve-first",
+        action="store_true",
+        help="match every show before importing any episodes, asking for any manual selections up front",
+    )
+    parser.add_argument(
+        "--defer-prompts",
+        action="store_true",
+        help="match every show first, but skip shows which need a manual selection instead of asking",
+    )
+    parser.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help="try the shows and episodes which couldn't be found by previous runs again",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        metavar="PATH",
+        help="save timings and counters of the import to a JSON file, or in Prometheus' text format if it ends in .prom",
+    )
+    parser.add_argument(
+        "--skip-watched",
+        action="store_true",
+        help="download your Trakt watch history first, and skip episodes which are already watched",
+    )
+    parser.add_argument(
+        "--base-url",
+        metavar="URL",
+        help="send the requests to another address for Trakt's API, e.g a local stand-in server",
+    )
+    args = parser.parse_args()
+
+    if args.base_url:
+        useTraktBaseUrl(args.base_url)
+
+    # Explicitly invalidate the show cache, if requested
+    if args.clear_show_cache:
+        showCache.invalidate()
+    if args.retry_failed:
+        failureCache.forget()
+    for showName in args.forget_show:
+        titleObj = getYearFromTitle(showName)
+        forgetShowMappings(showName=titleObj.titleWithoutYear)
+        failureCache.forget(showName=titleObj.titleWithoutYear)
+        showCache.invalidate(
+            title=titleObj.titleWithoutYear,
+            year=titleObj.yearValue if titleObj.yearValue != -1 else None,
+        )
+
+    backup_filename = args.backup_filename
     if not os.path.exists(backup_filename):
         logging.error(f'The backup file "{backup_filename}" does not exist.')
         sys.exit(1)
 
     # Check that the user has created the config file
     if os.path.exists("config.json"):
-        start(backup_filename)
+        start(
+            backup_filename,
+            stream=args.stream,
+            resolve_first=args.resolve_first or args.defer_prompts,
+            defer_prompts=args.defer_prompts,
+            skip_watched=args.skip_watched,
+            metrics_file=args.metrics_file,
+        )
     else:
         logging.error(
             "The 'config.json' file cannot be found - have you created it yet?"